@@ -42,6 +42,7 @@ CREATE TABLE restaurant (
     longitude REAL,
     theme TEXT NOT NULL DEFAULT 'Standard',
     stripekey TEXT,
+    stripeWebhookSecret TEXT, -- encrypted signing secret of the restaurant's Stripe webhook endpoint
     openingtime TEXT,
     closingtime TEXT,
     description TEXT,
@@ -144,21 +145,258 @@ CREATE TABLE orders (
     orderComplete BOOLEAN NOT NULL,
     comments TEXT,
     ispaid BOOLEAN NOT NULL DEFAULT FALSE,
+    changeXid xid8 NOT NULL DEFAULT pg_current_xact_id(), -- transaction that last changed the order, for delta sync
+    stripeSessionId TEXT, -- latest Stripe checkout session for the order
     FOREIGN KEY (userID) REFERENCES users(id),
     FOREIGN KEY (tableID) REFERENCES RestaurantTable(id),
     FOREIGN KEY (restaurantID) REFERENCES Restaurant(id)
 );
 
+CREATE INDEX orders_restaurant_change_idx ON orders (restaurantID, changeXid);
+CREATE UNIQUE INDEX orders_stripe_session_idx ON orders (stripeSessionId) WHERE stripeSessionId IS NOT NULL;
+-- Kitchen queries only look at open orders, and archival only at finished ones
+CREATE INDEX orders_open_idx ON orders (restaurantID) WHERE NOT orderComplete;
+CREATE INDEX orders_archivable_idx ON orders (orderTime) WHERE orderComplete AND isPaid;
+
 
 -- 15) OrderIncludesMenuItem
 CREATE TABLE OrderIncludesMenuItem (
     id SERIAL PRIMARY KEY,    -- Use SERIAL instead of AUTOINCREMENT
     orderID INTEGER NOT NULL,
     menuItemID INTEGER NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 1 CHECK (quantity > 0),
+    unitPrice REAL NOT NULL, -- price of the menu item when the order was placed
+    UNIQUE (orderID, menuItemID),
     FOREIGN KEY (orderID) REFERENCES orders(id),
     FOREIGN KEY (menuItemID) REFERENCES MenuItem(id)
 );
 
+-- 16) IdempotencyKeys
+-- Responses stored for requests sent with an Idempotency-Key header, replayed on retries
+CREATE TABLE idempotencyKeys (
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    requestHash TEXT NOT NULL, -- sha256 of the request body, to reject a key reused for another request
+    statusCode INTEGER NOT NULL,
+    responseBody JSONB NOT NULL,
+    createdAt TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (endpoint, key)
+);
+
+CREATE INDEX idempotency_keys_created_idx ON idempotencyKeys (createdAt);
+
+-- 17) EmailOutbox
+-- Emails queued by requests and sent by the mailer worker (db_test/mailer.py)
+CREATE TABLE emailOutbox (
+    id SERIAL PRIMARY KEY,
+    toEmail TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    nextAttemptAt TIMESTAMPTZ NOT NULL DEFAULT now(),
+    lastError TEXT,
+    createdAt TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sentAt TIMESTAMPTZ
+);
+
+CREATE INDEX email_outbox_pending_idx ON emailOutbox (nextAttemptAt) WHERE sentAt IS NULL;
+
+-- 18) Order archive
+-- Cold storage for orders that are completed and paid, partitioned by month.
+-- Rows are moved here by archive_orders(), so the live queries on orders only
+-- see the small set of open orders. orders_archive has the columns of orders,
+-- so a column added to orders must be added here too.
+CREATE TABLE orders_archive (
+    LIKE orders,
+    PRIMARY KEY (id, orderTime)
+) PARTITION BY RANGE (orderTime);
+
+CREATE INDEX orders_archive_restaurant_idx ON orders_archive (restaurantID, orderTime);
+CREATE INDEX orders_archive_stripe_session_idx ON orders_archive (stripeSessionId) WHERE stripeSessionId IS NOT NULL;
+
+CREATE TABLE OrderIncludesMenuItem_archive (
+    orderID INTEGER NOT NULL,
+    menuItemID INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    unitPrice REAL NOT NULL,
+    orderTime TIMESTAMP NOT NULL, -- of the order, to partition the lines alongside it
+    PRIMARY KEY (orderID, menuItemID, orderTime)
+) PARTITION BY RANGE (orderTime);
+
+-- Highest changeXid among archived orders. Delta sync cursors at or below it
+-- may have missed a tombstone and must start over.
+CREATE TABLE orderArchiveWatermark (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    changeXid xid8 NOT NULL DEFAULT '0'
+);
+
+INSERT INTO orderArchiveWatermark DEFAULT VALUES;
+
+-- Creates the archive partitions for the month starting at p_month, if missing
+CREATE OR REPLACE FUNCTION create_order_archive_partition(p_month DATE)
+RETURNS VOID AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::DATE;
+    v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::DATE;
+    v_suffix TEXT := to_char(p_month, 'YYYY_MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF orders_archive FOR VALUES FROM (%L) TO (%L)',
+        'orders_archive_' || v_suffix, v_start, v_end);
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF OrderIncludesMenuItem_archive FOR VALUES FROM (%L) TO (%L)',
+        'orderincludesmenuitem_archive_' || v_suffix, v_start, v_end);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Moves up to p_batch_size completed and paid orders placed more than
+-- p_older_than ago, with their items, into the archive.
+-- Returns the number of orders moved.
+CREATE OR REPLACE FUNCTION archive_orders(p_older_than INTERVAL, p_batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_ids INTEGER[];
+    v_month DATE;
+BEGIN
+    SELECT array_agg(id) INTO v_ids
+    FROM (
+        SELECT id
+        FROM orders
+        WHERE orderComplete AND isPaid
+        AND orderTime < now() - p_older_than
+        ORDER BY orderTime
+        LIMIT p_batch_size
+        FOR UPDATE SKIP LOCKED
+    ) archivable;
+
+    IF v_ids IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    FOR v_month IN
+        SELECT DISTINCT date_trunc('month', orderTime)::DATE FROM orders WHERE id = ANY(v_ids)
+    LOOP
+        PERFORM create_order_archive_partition(v_month);
+    END LOOP;
+
+    WITH moved AS (
+        DELETE FROM OrderIncludesMenuItem
+        WHERE orderID = ANY(v_ids)
+        RETURNING orderID, menuItemID, quantity, unitPrice
+    )
+    INSERT INTO OrderIncludesMenuItem_archive (orderID, menuItemID, quantity, unitPrice, orderTime)
+    SELECT m.orderID, m.menuItemID, m.quantity, m.unitPrice, o.orderTime
+    FROM moved m
+    JOIN orders o ON o.id = m.orderID;
+
+    UPDATE orderArchiveWatermark
+    SET changeXid = GREATEST(changeXid, (SELECT max(changeXid) FROM orders WHERE id = ANY(v_ids)));
+
+    WITH moved AS (
+        DELETE FROM orders
+        WHERE id = ANY(v_ids)
+        RETURNING *
+    )
+    INSERT INTO orders_archive
+    SELECT * FROM moved;
+
+    RETURN array_length(v_ids, 1);
+END;
+$$ LANGUAGE plpgsql;
+
+-- 19) LoginThrottle
+-- Login attempts per email and per client address in the current throttle window.
+-- Unlogged: losing the counts in a crash only resets the throttle.
+CREATE UNLOGGED TABLE loginThrottle (
+    key TEXT PRIMARY KEY, -- 'email:<email>' or 'ip:<address>'
+    windowStart TIMESTAMPTZ NOT NULL DEFAULT now(),
+    attempts INTEGER NOT NULL DEFAULT 1,
+    maxAttempts INTEGER NOT NULL
+);
+
+-- 20) RestaurantOpeningHours
+-- Opening hours as minute-of-week ranges, 0 being Monday 00:00 local time. Derived
+-- from restaurant.openingtime/closingtime by the restaurant_opening_hours trigger.
+CREATE TABLE restaurantOpeningHours (
+    restaurantID INTEGER NOT NULL,
+    minutes INT4RANGE NOT NULL,
+    FOREIGN KEY (restaurantID) REFERENCES restaurant(id) ON DELETE CASCADE
+);
+
+CREATE INDEX restaurant_opening_hours_minutes_idx ON restaurantOpeningHours USING GIST (minutes);
+CREATE INDEX restaurant_opening_hours_restaurant_idx ON restaurantOpeningHours (restaurantID);
+
+-- 21) SchemaMigrations
+-- The db-migrations files applied to this database, by db-migrations/migrate.sh.
+-- This schema already includes every migration so far; add new ones here as well.
+CREATE TABLE schemaMigrations (
+    name TEXT PRIMARY KEY,
+    appliedAt TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO schemaMigrations (name) VALUES
+    ('001_place_order.sql'),
+    ('002_order_line_quantities.sql'),
+    ('003_order_events.sql'),
+    ('004_order_change_xid.sql'),
+    ('005_idempotency_keys.sql'),
+    ('006_email_outbox.sql'),
+    ('007_stripe_webhooks.sql'),
+    ('008_order_archive.sql'),
+    ('009_login_throttle.sql'),
+    ('010_restaurant_changes.sql'),
+    ('011_opening_hours.sql');
+
+-- Places an order in a single call: validates the table and menu items,
+-- prices the items, and inserts the order together with its items.
+-- p_menu_items and p_quantities are parallel arrays.
+CREATE OR REPLACE FUNCTION place_order(
+    p_restaurant_id INTEGER,
+    p_user_id INTEGER,
+    p_table INTEGER,
+    p_comments TEXT,
+    p_menu_items INTEGER[],
+    p_quantities INTEGER[]
+)
+RETURNS TABLE (order_id INTEGER, order_total REAL) AS $$
+DECLARE
+    v_total_tables INTEGER;
+    v_missing INTEGER;
+BEGIN
+    SELECT item INTO v_missing
+    FROM unnest(p_menu_items) AS item
+    WHERE NOT EXISTS (SELECT 1 FROM MenuItem WHERE id = item)
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'Menu item not found: %', v_missing USING ERRCODE = 'no_data_found';
+    END IF;
+
+    SELECT totaltables INTO v_total_tables FROM restaurant WHERE id = p_restaurant_id;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Restaurant not found' USING ERRCODE = 'no_data_found';
+    END IF;
+    IF p_table > v_total_tables THEN
+        RAISE EXCEPTION 'Table does not exist' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    SELECT COALESCE(SUM(mi.price * line.quantity), 0) INTO order_total
+    FROM unnest(p_menu_items, p_quantities) AS line(menuItemID, quantity)
+    JOIN MenuItem mi ON mi.id = line.menuItemID;
+
+    INSERT INTO orders (restaurantID, userID, tableID, orderCost, orderComplete, orderTime, comments)
+    VALUES (p_restaurant_id, p_user_id, p_table, order_total, FALSE, now(), p_comments)
+    RETURNING id INTO order_id;
+
+    INSERT INTO OrderIncludesMenuItem (orderID, menuItemID, quantity, unitPrice)
+    SELECT order_id, mi.id, SUM(line.quantity), mi.price
+    FROM unnest(p_menu_items, p_quantities) AS line(menuItemID, quantity)
+    JOIN MenuItem mi ON mi.id = line.menuItemID
+    GROUP BY mi.id, mi.price;
+
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
 CREATE OR REPLACE FUNCTION set_average_rating()
 RETURNS TRIGGER AS $$
 BEGIN
@@ -182,5 +420,139 @@ FOR EACH ROW
 EXECUTE FUNCTION set_average_rating();
 
 
+-- Publishes order lifecycle events for the live kitchen feed
+CREATE OR REPLACE FUNCTION notify_order_event()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_events TEXT[] := '{}';
+    v_event TEXT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        v_events := ARRAY['created'];
+    ELSE
+        IF NEW.orderComplete AND NOT OLD.orderComplete THEN
+            v_events := v_events || 'completed'::TEXT;
+        END IF;
+        IF NEW.isPaid AND NOT OLD.isPaid THEN
+            v_events := v_events || 'paid'::TEXT;
+        END IF;
+    END IF;
+
+    FOREACH v_event IN ARRAY v_events LOOP
+        PERFORM pg_notify('order_events', json_build_object(
+            'event', v_event,
+            'orderId', NEW.id,
+            'restaurantId', NEW.restaurantID,
+            'tableId', NEW.tableID,
+            'orderCost', NEW.orderCost
+        )::TEXT);
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER order_events
+AFTER INSERT OR UPDATE OF orderComplete, isPaid ON orders
+FOR EACH ROW
+EXECUTE FUNCTION notify_order_event();
+
+
+-- Stamps updated orders with the changing transaction so clients can sync deltas
+CREATE OR REPLACE FUNCTION set_order_change_xid()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.changeXid := pg_current_xact_id();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER order_change_xid
+BEFORE UPDATE ON orders
+FOR EACH ROW
+EXECUTE FUNCTION set_order_change_xid();
 
 
+-- Tells every API worker which restaurant changed, so their spatial indexes stay current
+CREATE OR REPLACE FUNCTION notify_restaurant_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('restaurant_changes', OLD.id::TEXT);
+    ELSE
+        PERFORM pg_notify('restaurant_changes', NEW.id::TEXT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER restaurant_changes
+AFTER INSERT OR UPDATE OR DELETE ON restaurant
+FOR EACH ROW
+EXECUTE FUNCTION notify_restaurant_change();
+
+
+-- Minutes after midnight of a time of day such as '09:00' or '24:00', NULL if it is not one
+CREATE OR REPLACE FUNCTION parse_time_of_day(p_text TEXT)
+RETURNS INTEGER AS $$
+BEGIN
+    RETURN (extract(epoch FROM p_text::TIME) / 60)::INTEGER;
+EXCEPTION WHEN invalid_datetime_format OR datetime_field_overflow THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- The minute-of-week ranges a restaurant open daily from p_opening to p_closing is open.
+-- A closing time at or before the opening time means it closes after midnight, and the
+-- Sunday night hours wrap around to Monday morning.
+CREATE OR REPLACE FUNCTION opening_hours_ranges(p_opening TEXT, p_closing TEXT)
+RETURNS SETOF INT4RANGE AS $$
+DECLARE
+    v_open INTEGER := parse_time_of_day(p_opening);
+    v_close INTEGER := parse_time_of_day(p_closing);
+    v_day INTEGER;
+    v_start INTEGER;
+    v_stop INTEGER;
+BEGIN
+    IF v_open IS NULL OR v_close IS NULL THEN
+        RETURN;
+    END IF;
+    IF v_close <= v_open THEN
+        v_close := v_close + 1440;
+    END IF;
+
+    FOR v_day IN 0..6 LOOP
+        v_start := v_day * 1440 + v_open;
+        v_stop := v_day * 1440 + v_close;
+        IF v_stop > 10080 THEN
+            RETURN NEXT int4range(v_start, 10080);
+            RETURN NEXT int4range(0, v_stop - 10080);
+        ELSE
+            RETURN NEXT int4range(v_start, v_stop);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- Keeps restaurantOpeningHours in step with the restaurant's opening and closing times
+CREATE OR REPLACE FUNCTION set_restaurant_opening_hours()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM restaurantOpeningHours WHERE restaurantID = NEW.id;
+    INSERT INTO restaurantOpeningHours (restaurantID, minutes)
+    SELECT NEW.id, ranges.minutes
+    FROM opening_hours_ranges(NEW.openingtime, NEW.closingtime) AS ranges(minutes);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER restaurant_opening_hours
+AFTER INSERT OR UPDATE OF openingtime, closingtime ON restaurant
+FOR EACH ROW
+EXECUTE FUNCTION set_restaurant_opening_hours();
@@ -0,0 +1,47 @@
+-- Migration for databases created before place_order existed.
+-- Fresh databases get the same definition from db-init-scripts/create.sql.
+
+-- Places an order in a single call: validates the table and menu items,
+-- prices the items, and inserts the order together with its items.
+CREATE OR REPLACE FUNCTION place_order(
+    p_restaurant_id INTEGER,
+    p_user_id INTEGER,
+    p_table INTEGER,
+    p_comments TEXT,
+    p_menu_items INTEGER[]
+)
+RETURNS TABLE (order_id INTEGER, order_total REAL) AS $$
+DECLARE
+    v_total_tables INTEGER;
+    v_missing INTEGER;
+BEGIN
+    SELECT item INTO v_missing
+    FROM unnest(p_menu_items) AS item
+    WHERE NOT EXISTS (SELECT 1 FROM MenuItem WHERE id = item)
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'Menu item not found: %', v_missing USING ERRCODE = 'no_data_found';
+    END IF;
+
+    SELECT totaltables INTO v_total_tables FROM restaurant WHERE id = p_restaurant_id;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Restaurant not found' USING ERRCODE = 'no_data_found';
+    END IF;
+    IF p_table > v_total_tables THEN
+        RAISE EXCEPTION 'Table does not exist' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    SELECT COALESCE(SUM(mi.price), 0) INTO order_total
+    FROM unnest(p_menu_items) AS item
+    JOIN MenuItem mi ON mi.id = item;
+
+    INSERT INTO orders (restaurantID, userID, tableID, orderCost, orderComplete, orderTime, comments)
+    VALUES (p_restaurant_id, p_user_id, p_table, order_total, FALSE, now(), p_comments)
+    RETURNING id INTO order_id;
+
+    INSERT INTO OrderIncludesMenuItem (orderID, menuItemID)
+    SELECT order_id, item FROM unnest(p_menu_items) AS item;
+
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
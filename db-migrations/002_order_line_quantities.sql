@@ -0,0 +1,93 @@
+-- Migration for databases created before order lines had quantities.
+-- Fresh databases get the same schema from db-init-scripts/create.sql.
+-- Collapses the old one-row-per-unit OrderIncludesMenuItem rows into one
+-- row per menu item with a quantity and the unit price.
+
+BEGIN;
+
+ALTER TABLE OrderIncludesMenuItem
+    ADD COLUMN quantity INTEGER NOT NULL DEFAULT 1 CHECK (quantity > 0),
+    ADD COLUMN unitPrice REAL;
+
+CREATE TEMPORARY TABLE collapsed_lines ON COMMIT DROP AS
+SELECT MIN(id) AS id, orderID, menuItemID, COUNT(*) AS quantity
+FROM OrderIncludesMenuItem
+GROUP BY orderID, menuItemID;
+
+DELETE FROM OrderIncludesMenuItem oim
+USING collapsed_lines c
+WHERE oim.orderID = c.orderID
+AND oim.menuItemID = c.menuItemID
+AND oim.id <> c.id;
+
+UPDATE OrderIncludesMenuItem oim
+SET quantity = c.quantity
+FROM collapsed_lines c
+WHERE oim.id = c.id;
+
+-- Historic prices were not recorded, the current price is the best estimate
+UPDATE OrderIncludesMenuItem oim
+SET unitPrice = mi.price
+FROM MenuItem mi
+WHERE mi.id = oim.menuItemID;
+
+ALTER TABLE OrderIncludesMenuItem
+    ALTER COLUMN unitPrice SET NOT NULL,
+    ADD UNIQUE (orderID, menuItemID);
+
+DROP FUNCTION place_order(INTEGER, INTEGER, INTEGER, TEXT, INTEGER[]);
+
+-- Places an order in a single call: validates the table and menu items,
+-- prices the items, and inserts the order together with its items.
+-- p_menu_items and p_quantities are parallel arrays.
+CREATE OR REPLACE FUNCTION place_order(
+    p_restaurant_id INTEGER,
+    p_user_id INTEGER,
+    p_table INTEGER,
+    p_comments TEXT,
+    p_menu_items INTEGER[],
+    p_quantities INTEGER[]
+)
+RETURNS TABLE (order_id INTEGER, order_total REAL) AS $$
+DECLARE
+    v_total_tables INTEGER;
+    v_missing INTEGER;
+BEGIN
+    SELECT item INTO v_missing
+    FROM unnest(p_menu_items) AS item
+    WHERE NOT EXISTS (SELECT 1 FROM MenuItem WHERE id = item)
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'Menu item not found: %', v_missing USING ERRCODE = 'no_data_found';
+    END IF;
+
+    SELECT totaltables INTO v_total_tables FROM restaurant WHERE id = p_restaurant_id;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Restaurant not found' USING ERRCODE = 'no_data_found';
+    END IF;
+    IF p_table > v_total_tables THEN
+        RAISE EXCEPTION 'Table does not exist' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    SELECT COALESCE(SUM(mi.price * line.quantity), 0) INTO order_total
+    FROM unnest(p_menu_items, p_quantities) AS line(menuItemID, quantity)
+    JOIN MenuItem mi ON mi.id = line.menuItemID;
+
+    INSERT INTO orders (restaurantID, userID, tableID, orderCost, orderComplete, orderTime, comments)
+    VALUES (p_restaurant_id, p_user_id, p_table, order_total, FALSE, now(), p_comments)
+    RETURNING id INTO order_id;
+
+    INSERT INTO OrderIncludesMenuItem (orderID, menuItemID, quantity, unitPrice)
+    SELECT order_id, mi.id, SUM(line.quantity), mi.price
+    FROM unnest(p_menu_items, p_quantities) AS line(menuItemID, quantity)
+    JOIN MenuItem mi ON mi.id = line.menuItemID
+    GROUP BY mi.id, mi.price;
+
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
+
+-- Give the space of the removed rows back
+VACUUM (FULL, ANALYZE) OrderIncludesMenuItem;
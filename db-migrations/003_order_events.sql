@@ -0,0 +1,40 @@
+-- Migration for databases created before the live order feed existed.
+-- Fresh databases get the same trigger from db-init-scripts/create.sql.
+
+-- Publishes order lifecycle events for the live kitchen feed
+CREATE OR REPLACE FUNCTION notify_order_event()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_events TEXT[] := '{}';
+    v_event TEXT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        v_events := ARRAY['created'];
+    ELSE
+        IF NEW.orderComplete AND NOT OLD.orderComplete THEN
+            v_events := v_events || 'completed'::TEXT;
+        END IF;
+        IF NEW.isPaid AND NOT OLD.isPaid THEN
+            v_events := v_events || 'paid'::TEXT;
+        END IF;
+    END IF;
+
+    FOREACH v_event IN ARRAY v_events LOOP
+        PERFORM pg_notify('order_events', json_build_object(
+            'event', v_event,
+            'orderId', NEW.id,
+            'restaurantId', NEW.restaurantID,
+            'tableId', NEW.tableID,
+            'orderCost', NEW.orderCost
+        )::TEXT);
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER order_events
+AFTER INSERT OR UPDATE OF orderComplete, isPaid ON orders
+FOR EACH ROW
+EXECUTE FUNCTION notify_order_event();
@@ -0,0 +1,23 @@
+-- Migration for databases created before delta sync of orders/byrestaurant.
+-- Fresh databases get the same column, index and trigger from db-init-scripts/create.sql.
+
+-- Existing rows get the migrating transaction, so the first delta after
+-- the migration returns every order once
+ALTER TABLE orders ADD COLUMN changeXid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+CREATE INDEX orders_restaurant_change_idx ON orders (restaurantID, changeXid);
+
+-- Stamps updated orders with the changing transaction so clients can sync deltas
+CREATE OR REPLACE FUNCTION set_order_change_xid()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.changeXid := pg_current_xact_id();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER order_change_xid
+BEFORE UPDATE ON orders
+FOR EACH ROW
+EXECUTE FUNCTION set_order_change_xid();
@@ -0,0 +1,15 @@
+-- Migration for databases created before Idempotency-Key support on POST /orders/add.
+-- Fresh databases get the same table from db-init-scripts/create.sql.
+
+-- Responses stored for requests sent with an Idempotency-Key header, replayed on retries
+CREATE TABLE idempotencyKeys (
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    requestHash TEXT NOT NULL, -- sha256 of the request body, to reject a key reused for another request
+    statusCode INTEGER NOT NULL,
+    responseBody JSONB NOT NULL,
+    createdAt TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (endpoint, key)
+);
+
+CREATE INDEX idempotency_keys_created_idx ON idempotencyKeys (createdAt);
@@ -0,0 +1,17 @@
+-- Migration for databases created before order confirmation emails went through an outbox.
+-- Fresh databases get the same table from db-init-scripts/create.sql.
+
+-- Emails queued by requests and sent by the mailer worker (db_test/mailer.py)
+CREATE TABLE emailOutbox (
+    id SERIAL PRIMARY KEY,
+    toEmail TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    nextAttemptAt TIMESTAMPTZ NOT NULL DEFAULT now(),
+    lastError TEXT,
+    createdAt TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sentAt TIMESTAMPTZ
+);
+
+CREATE INDEX email_outbox_pending_idx ON emailOutbox (nextAttemptAt) WHERE sentAt IS NULL;
@@ -0,0 +1,10 @@
+-- Migration for databases created before Stripe webhooks marked orders paid.
+-- Fresh databases get the same columns and index from db-init-scripts/create.sql.
+
+-- Encrypted signing secret of the restaurant's Stripe webhook endpoint
+ALTER TABLE restaurant ADD COLUMN stripeWebhookSecret TEXT;
+
+-- Latest Stripe checkout session for the order
+ALTER TABLE orders ADD COLUMN stripeSessionId TEXT;
+
+CREATE UNIQUE INDEX orders_stripe_session_idx ON orders (stripeSessionId) WHERE stripeSessionId IS NOT NULL;
@@ -0,0 +1,109 @@
+-- Migration for databases created before completed orders were archived.
+-- Fresh databases get the same tables, indexes and functions from db-init-scripts/create.sql.
+-- Existing completed and paid orders move to the archive on the first run of db_test/maintenance.py.
+
+-- Kitchen queries only look at open orders, and archival only at finished ones
+CREATE INDEX orders_open_idx ON orders (restaurantID) WHERE NOT orderComplete;
+CREATE INDEX orders_archivable_idx ON orders (orderTime) WHERE orderComplete AND isPaid;
+
+-- Cold storage for orders that are completed and paid, partitioned by month.
+-- Rows are moved here by archive_orders(), so the live queries on orders only
+-- see the small set of open orders. orders_archive has the columns of orders,
+-- so a column added to orders must be added here too.
+CREATE TABLE orders_archive (
+    LIKE orders,
+    PRIMARY KEY (id, orderTime)
+) PARTITION BY RANGE (orderTime);
+
+CREATE INDEX orders_archive_restaurant_idx ON orders_archive (restaurantID, orderTime);
+CREATE INDEX orders_archive_stripe_session_idx ON orders_archive (stripeSessionId) WHERE stripeSessionId IS NOT NULL;
+
+CREATE TABLE OrderIncludesMenuItem_archive (
+    orderID INTEGER NOT NULL,
+    menuItemID INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    unitPrice REAL NOT NULL,
+    orderTime TIMESTAMP NOT NULL, -- of the order, to partition the lines alongside it
+    PRIMARY KEY (orderID, menuItemID, orderTime)
+) PARTITION BY RANGE (orderTime);
+
+-- Highest changeXid among archived orders. Delta sync cursors at or below it
+-- may have missed a tombstone and must start over.
+CREATE TABLE orderArchiveWatermark (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    changeXid xid8 NOT NULL DEFAULT '0'
+);
+
+INSERT INTO orderArchiveWatermark DEFAULT VALUES;
+
+-- Creates the archive partitions for the month starting at p_month, if missing
+CREATE OR REPLACE FUNCTION create_order_archive_partition(p_month DATE)
+RETURNS VOID AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::DATE;
+    v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::DATE;
+    v_suffix TEXT := to_char(p_month, 'YYYY_MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF orders_archive FOR VALUES FROM (%L) TO (%L)',
+        'orders_archive_' || v_suffix, v_start, v_end);
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF OrderIncludesMenuItem_archive FOR VALUES FROM (%L) TO (%L)',
+        'orderincludesmenuitem_archive_' || v_suffix, v_start, v_end);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Moves up to p_batch_size completed and paid orders placed more than
+-- p_older_than ago, with their items, into the archive.
+-- Returns the number of orders moved.
+CREATE OR REPLACE FUNCTION archive_orders(p_older_than INTERVAL, p_batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_ids INTEGER[];
+    v_month DATE;
+BEGIN
+    SELECT array_agg(id) INTO v_ids
+    FROM (
+        SELECT id
+        FROM orders
+        WHERE orderComplete AND isPaid
+        AND orderTime < now() - p_older_than
+        ORDER BY orderTime
+        LIMIT p_batch_size
+        FOR UPDATE SKIP LOCKED
+    ) archivable;
+
+    IF v_ids IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    FOR v_month IN
+        SELECT DISTINCT date_trunc('month', orderTime)::DATE FROM orders WHERE id = ANY(v_ids)
+    LOOP
+        PERFORM create_order_archive_partition(v_month);
+    END LOOP;
+
+    WITH moved AS (
+        DELETE FROM OrderIncludesMenuItem
+        WHERE orderID = ANY(v_ids)
+        RETURNING orderID, menuItemID, quantity, unitPrice
+    )
+    INSERT INTO OrderIncludesMenuItem_archive (orderID, menuItemID, quantity, unitPrice, orderTime)
+    SELECT m.orderID, m.menuItemID, m.quantity, m.unitPrice, o.orderTime
+    FROM moved m
+    JOIN orders o ON o.id = m.orderID;
+
+    UPDATE orderArchiveWatermark
+    SET changeXid = GREATEST(changeXid, (SELECT max(changeXid) FROM orders WHERE id = ANY(v_ids)));
+
+    WITH moved AS (
+        DELETE FROM orders
+        WHERE id = ANY(v_ids)
+        RETURNING *
+    )
+    INSERT INTO orders_archive
+    SELECT * FROM moved;
+
+    RETURN array_length(v_ids, 1);
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,11 @@
+-- Migration for databases created before admin logins were throttled.
+-- Fresh databases get the same table from db-init-scripts/create.sql.
+
+-- Login attempts per email and per client address in the current throttle window.
+-- Unlogged: losing the counts in a crash only resets the throttle.
+CREATE UNLOGGED TABLE loginThrottle (
+    key TEXT PRIMARY KEY, -- 'email:<email>' or 'ip:<address>'
+    windowStart TIMESTAMPTZ NOT NULL DEFAULT now(),
+    attempts INTEGER NOT NULL DEFAULT 1,
+    maxAttempts INTEGER NOT NULL
+);
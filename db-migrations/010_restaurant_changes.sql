@@ -0,0 +1,21 @@
+-- Migration for databases created before the in-memory restaurant spatial index existed.
+-- Fresh databases get the same trigger from db-init-scripts/create.sql.
+
+-- Tells every API worker which restaurant changed, so their spatial indexes stay current
+CREATE OR REPLACE FUNCTION notify_restaurant_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('restaurant_changes', OLD.id::TEXT);
+    ELSE
+        PERFORM pg_notify('restaurant_changes', NEW.id::TEXT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER restaurant_changes
+AFTER INSERT OR UPDATE OR DELETE ON restaurant
+FOR EACH ROW
+EXECUTE FUNCTION notify_restaurant_change();
@@ -0,0 +1,82 @@
+-- Migration for databases created before opening hours were indexed.
+-- Fresh databases get the same table and trigger from db-init-scripts/create.sql.
+
+-- Opening hours as minute-of-week ranges, 0 being Monday 00:00 local time. Derived
+-- from restaurant.openingtime/closingtime by the restaurant_opening_hours trigger.
+CREATE TABLE restaurantOpeningHours (
+    restaurantID INTEGER NOT NULL,
+    minutes INT4RANGE NOT NULL,
+    FOREIGN KEY (restaurantID) REFERENCES restaurant(id) ON DELETE CASCADE
+);
+
+CREATE INDEX restaurant_opening_hours_minutes_idx ON restaurantOpeningHours USING GIST (minutes);
+CREATE INDEX restaurant_opening_hours_restaurant_idx ON restaurantOpeningHours (restaurantID);
+
+
+-- Minutes after midnight of a time of day such as '09:00' or '24:00', NULL if it is not one
+CREATE OR REPLACE FUNCTION parse_time_of_day(p_text TEXT)
+RETURNS INTEGER AS $$
+BEGIN
+    RETURN (extract(epoch FROM p_text::TIME) / 60)::INTEGER;
+EXCEPTION WHEN invalid_datetime_format OR datetime_field_overflow THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- The minute-of-week ranges a restaurant open daily from p_opening to p_closing is open.
+-- A closing time at or before the opening time means it closes after midnight, and the
+-- Sunday night hours wrap around to Monday morning.
+CREATE OR REPLACE FUNCTION opening_hours_ranges(p_opening TEXT, p_closing TEXT)
+RETURNS SETOF INT4RANGE AS $$
+DECLARE
+    v_open INTEGER := parse_time_of_day(p_opening);
+    v_close INTEGER := parse_time_of_day(p_closing);
+    v_day INTEGER;
+    v_start INTEGER;
+    v_stop INTEGER;
+BEGIN
+    IF v_open IS NULL OR v_close IS NULL THEN
+        RETURN;
+    END IF;
+    IF v_close <= v_open THEN
+        v_close := v_close + 1440;
+    END IF;
+
+    FOR v_day IN 0..6 LOOP
+        v_start := v_day * 1440 + v_open;
+        v_stop := v_day * 1440 + v_close;
+        IF v_stop > 10080 THEN
+            RETURN NEXT int4range(v_start, 10080);
+            RETURN NEXT int4range(0, v_stop - 10080);
+        ELSE
+            RETURN NEXT int4range(v_start, v_stop);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- Keeps restaurantOpeningHours in step with the restaurant's opening and closing times
+CREATE OR REPLACE FUNCTION set_restaurant_opening_hours()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM restaurantOpeningHours WHERE restaurantID = NEW.id;
+    INSERT INTO restaurantOpeningHours (restaurantID, minutes)
+    SELECT NEW.id, ranges.minutes
+    FROM opening_hours_ranges(NEW.openingtime, NEW.closingtime) AS ranges(minutes);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER restaurant_opening_hours
+AFTER INSERT OR UPDATE OF openingtime, closingtime ON restaurant
+FOR EACH ROW
+EXECUTE FUNCTION set_restaurant_opening_hours();
+
+
+-- Existing restaurants
+INSERT INTO restaurantOpeningHours (restaurantID, minutes)
+SELECT restaurant.id, ranges.minutes
+FROM restaurant, opening_hours_ranges(restaurant.openingtime, restaurant.closingtime) AS ranges(minutes);
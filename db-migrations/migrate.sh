@@ -0,0 +1,34 @@
+#!/bin/bash
+# Applies the migrations in this directory that the database has not had yet, in order.
+# Each runs in one transaction, unless it manages its own with a top-level BEGIN; (as
+# 002 does to VACUUM afterwards), and is then recorded in schemaMigrations.
+#
+#   db-migrations/migrate.sh                  # psql in the compose postgres service
+#   PSQL="psql $DATABASE_URL" db-migrations/migrate.sh
+set -euo pipefail
+
+cd "$(dirname "$0")"
+PSQL=${PSQL:-"docker compose exec -T postgres psql -U myuser -d mydatabase"}
+
+$PSQL -v ON_ERROR_STOP=1 -q <<'EOSQL'
+CREATE TABLE IF NOT EXISTS schemaMigrations (
+    name TEXT PRIMARY KEY,
+    appliedAt TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+EOSQL
+
+applied=$($PSQL -At -c "SELECT name FROM schemaMigrations")
+
+for migration in [0-9]*.sql; do
+    if grep -qxF "$migration" <<< "$applied"; then
+        continue
+    fi
+    echo "Applying $migration"
+    if grep -qx 'BEGIN;' "$migration"; then
+        $PSQL -v ON_ERROR_STOP=1 -q < "$migration"
+        $PSQL -v ON_ERROR_STOP=1 -q -c "INSERT INTO schemaMigrations (name) VALUES ('$migration')"
+    else
+        { cat "$migration"; echo; echo "INSERT INTO schemaMigrations (name) VALUES ('$migration');"; } \
+            | $PSQL -v ON_ERROR_STOP=1 -q --single-transaction
+    fi
+done
@@ -0,0 +1,17 @@
+#!/bin/bash
+# Starts postgres-replica as a hot standby of postgres, cloning the primary on first start
+set -e
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    export PGPASSWORD="$POSTGRES_PASSWORD"
+    # The primary refuses connections until it has run its init scripts
+    until pg_basebackup --host=postgres --username="$POSTGRES_USER" --pgdata="$PGDATA" \
+            --wal-method=stream --write-recovery-conf; do
+        rm -rf "${PGDATA:?}"/*
+        sleep 2
+    done
+    chmod 700 "$PGDATA"
+fi
+
+# --write-recovery-conf left standby.signal and primary_conninfo, so this starts in recovery
+exec postgres -c hot_standby=on
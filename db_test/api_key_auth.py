@@ -0,0 +1,145 @@
+from flask import request, jsonify, g
+from database import query_db, insert_db
+from notifications import get_listener
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import os
+import threading
+import time
+
+# Seconds a verified key is trusted before it is looked up again
+API_KEY_CACHE_TTL = int(os.environ.get("API_KEY_CACHE_TTL", 60))
+API_KEY_CACHE_SIZE = int(os.environ.get("API_KEY_CACHE_SIZE", 1024))
+
+
+def hash_api_key(apikey):
+    """API keys are stored as their SHA-256 hex digest."""
+    return hashlib.sha256(apikey.encode()).hexdigest()
+
+
+class ApiKeyCache:
+    """Per-worker LRU of key hash -> restaurant ID for recently verified keys.
+
+    Only keys that exist are cached, so a new key needs no invalidation. Revoked
+    keys are dropped in every worker through the api_keys NOTIFY channel, and the
+    cache is bypassed whenever that channel is not listened to.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.pid = os.getpid()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed = False
+        # The listener connection the entries were cached under
+        self._connection = None
+
+    def get(self, hashed_key):
+        if not self._listen():
+            return None
+        with self._lock:
+            entry = self._entries.get(hashed_key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[hashed_key]
+                return None
+            self._entries.move_to_end(hashed_key)
+            return entry[0]
+
+    def put(self, hashed_key, restaurantID):
+        if not self._listen():
+            return
+        with self._lock:
+            self._entries[hashed_key] = (restaurantID, time.monotonic() + self.ttl)
+            self._entries.move_to_end(hashed_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, hashed_key):
+        with self._lock:
+            self._entries.pop(hashed_key, None)
+
+    def _listen(self):
+        """Subscribes to api_keys on first use. Returns whether revocations reach the cache
+        right now. Entries are dropped when the listener reconnected, as it may have missed
+        revocations in between."""
+        listener = get_listener()
+        if not self._subscribed:
+            with self._lock:
+                subscribe = not self._subscribed
+                self._subscribed = True
+            # Outside the lock, as it waits for the LISTEN to be issued
+            if subscribe:
+                listener.subscribe("api_keys", self.discard)
+        connection = listener.listening("api_keys")
+        if connection != self._connection:
+            with self._lock:
+                self._entries.clear()
+                self._connection = connection
+        return connection is not None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+    if _cache is None or _cache.pid != os.getpid():
+        with _cache_lock:
+            if _cache is None or _cache.pid != os.getpid():
+                _cache = ApiKeyCache(API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL)
+    return _cache
+
+
+def authenticate(apikey):
+    """Returns the ID of the restaurant the API key belongs to, or None."""
+    hashed_key = hash_api_key(apikey)
+    cache = _get_cache()
+    restaurantID = cache.get(hashed_key)
+    if restaurantID is not None:
+        return restaurantID
+
+    key = query_db("SELECT restaurantID FROM apikeys WHERE apikey = %s", args=(hashed_key,), one=True)
+    if not key:
+        return None
+    cache.put(hashed_key, key['restaurantid'])
+    return key['restaurantid']
+
+
+def invalidate(hashed_key):
+    """Drops a revoked key from the cache of every worker once the current transaction commits."""
+    _get_cache().discard(hashed_key)
+    insert_db("SELECT pg_notify('api_keys', %s)", args=(hashed_key,))
+
+
+def require_api_key(query_param=None):
+    """Requires a restaurant API key as a Bearer token and sets `g.restaurant_id`.
+
+    With `query_param` the key may instead be given in that query parameter, for
+    clients such as EventSource that cannot set headers.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            auth_header = request.headers.get("Authorization")
+            if auth_header:
+                try:
+                    apikey = auth_header.split(" ")[1]
+                except IndexError:
+                    return jsonify({"error": "Invalid authorization header format"}), 401
+            else:
+                apikey = request.args.get(query_param) if query_param else None
+            if not apikey:
+                return jsonify({"error": "Missing authorization header"}), 401
+
+            restaurantID = authenticate(apikey)
+            if restaurantID is None:
+                return jsonify({"error": "Incorrect key given"}), 401
+            g.restaurant_id = restaurantID
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
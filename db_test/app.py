@@ -3,8 +3,12 @@ from restaurantAPI import restaurant_api_blueprint
 from flasgger import Swagger
 from flask_cors import CORS
 from extensions import bcrypt, jwt
+from datetime import timedelta
+import database
+import os
 
 app = Flask(__name__)
+app.logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
 # Register the API blueprint
 app.register_blueprint(restaurant_api_blueprint)
@@ -15,8 +19,14 @@ CORS(app, origins="*", methods=["GET", "POST", "PUT", "DELETE"])
 
 
 app.config["JWT_SECRET_KEY"] = "MEGAGIGASECRETJAMNOWKEYSUPERSAFE!!!!!!"
+# Short-lived access tokens, renewed through /adminUsers/refresh instead of logging in again
+app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(minutes=int(os.environ.get("JWT_ACCESS_TOKEN_MINUTES", 15)))
+app.config["JWT_REFRESH_TOKEN_EXPIRES"] = timedelta(days=int(os.environ.get("JWT_REFRESH_TOKEN_DAYS", 14)))
+# Identities are {"id", "email"} objects, which newer PyJWT rejects as a subject by default
+app.config["JWT_VERIFY_SUB"] = False
 bcrypt.init_app(app)
 jwt.init_app(app)
+database.init_app(app)
 
 if __name__ == '__main__':
     app.run(port=8000)
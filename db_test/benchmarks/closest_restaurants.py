@@ -0,0 +1,83 @@
+"""Benchmarks ranking for /restaurants/closest.
+
+Compares the scalar haversine with a full sort, as the endpoint used to rank its
+candidates, against the vectorized haversine_many with top-k selection, and times
+whole SpatialIndex.nearest lookups. Runs on synthetic restaurants, no database needed.
+
+    cd db_test && python -m benchmarks.closest_restaurants
+"""
+from spatial_index import SpatialIndex, haversine, haversine_many, top_k
+import argparse
+import numpy as np
+import random
+import time
+
+# Copenhagen, where synthetic restaurants are packed most densely
+CENTRE = (55.676, 12.568)
+
+
+def synthetic_restaurants(count, seed):
+    """Restaurants clustered around CENTRE, thinning out over about 50 km."""
+    rng = random.Random(seed)
+    return [{
+        'id': i,
+        'name': f'Restaurant {i}',
+        'latitude': CENTRE[0] + rng.gauss(0, 0.15),
+        'longitude': CENTRE[1] + rng.gauss(0, 0.25),
+        'averagerating': rng.uniform(1, 5),
+    } for i in range(count)]
+
+
+def per_call(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def bench_ranking(restaurants, repeat):
+    print("Ranking N candidates for the 10 nearest (microseconds per call)")
+    print(f"{'N':>8} {'scalar + sort':>14} {'vectorized top-k':>17} {'speedup':>8}")
+    lat, lon = CENTRE
+    for n in (100, 1000, 10000, len(restaurants)):
+        candidates = restaurants[:n]
+        lats = np.array([row['latitude'] for row in candidates])
+        lons = np.array([row['longitude'] for row in candidates])
+
+        def scalar():
+            return sorted(candidates, key=lambda x: haversine(lat, lon, x['latitude'], x['longitude']))[:10]
+
+        def vectorized():
+            return [candidates[i] for i in top_k(haversine_many(lat, lon, lats, lons), 10)]
+
+        assert [row['id'] for row in scalar()] == [row['id'] for row in vectorized()]
+        scalar_us = per_call(scalar, max(1, repeat * 100 // n))
+        vectorized_us = per_call(vectorized, max(1, repeat * 100 // n))
+        print(f"{n:>8} {scalar_us:>14.1f} {vectorized_us:>17.1f} {scalar_us / vectorized_us:>7.1f}x")
+
+
+def bench_index(restaurants, repeat, seed):
+    index = SpatialIndex(0.02, float("inf"))
+    started = time.perf_counter()
+    index.replace(restaurants)
+    print(f"\nIndexed {len(restaurants)} restaurants in {time.perf_counter() - started:.2f} s")
+
+    rng = random.Random(seed)
+    points = [(CENTRE[0] + rng.gauss(0, 0.15), CENTRE[1] + rng.gauss(0, 0.25)) for _ in range(repeat)]
+    print("SpatialIndex.nearest, 10 results (microseconds per call)")
+    for radius_km, rating_weight in ((2, 0), (10, 0), (10, 0.5), (50, 0)):
+        queries = iter(points * 2)
+        us = per_call(lambda: index.nearest(*next(queries), radius_km, 10, rating_weight=rating_weight), repeat)
+        print(f"  radius {radius_km:>3} km, rating_weight {rating_weight:<4} {us:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--restaurants", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    restaurants = synthetic_restaurants(args.restaurants, args.seed)
+    bench_ranking(restaurants, args.repeat)
+    bench_index(restaurants, args.repeat, args.seed)
@@ -1,10 +1,8 @@
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from cryptography.fernet import Fernet
+from flask import Response, current_app, stream_with_context
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 bcrypt = Bcrypt()
 jwt = JWTManager()
@@ -17,21 +15,53 @@ def encrypt(value: str) -> str:
 def decrypt(value: str) -> str:
     return fernet.decrypt(value.encode()).decode()
 
-def send_order_confirmation(to_email, order, line_items):
-    from_email = os.getenv("GOOGLE_MAIL")
-    password = os.getenv("GOOGLE_PASSWORD")
+def stream_json(rows, chunk_size=100):
+    """Streams an iterable of rows as a JSON array response, `chunk_size` rows per chunk."""
+    def generate():
+        separator = "["
+        chunk = []
+        try:
+            for row in rows:
+                chunk.append(current_app.json.dumps(row))
+                if len(chunk) >= chunk_size:
+                    yield separator + ",".join(chunk)
+                    separator = ","
+                    chunk = []
+        finally:
+            # Release the cursor behind `rows` even if the client disconnects
+            close()
+        if chunk:
+            yield separator + ",".join(chunk)
+            separator = ","
+        yield "[]" if separator == "[" else "]"
 
+    close = getattr(rows, "close", None) or (lambda: None)
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    # Also when the body is never iterated, e.g. for HEAD requests
+    response.call_on_close(close)
+    return response
+
+def build_order_confirmation(order, items, amount_paid=None):
+    """Returns the (subject, body) of the confirmation email for a paid order.
+
+    `items` are the order's lines with name, quantity and price. Anything paid on
+    top of them, as reported by Stripe in `amount_paid`, is listed as a tip.
+    """
     subject = "Your Order Confirmation"
     item_lines = []
     total = 0
-    for item in line_items.data:
-        name = item.description
-        quantity = item.quantity
-        amount_each = item.price.unit_amount / 100  
+    for item in items:
+        name = item['name']
+        quantity = item['quantity']
+        amount_each = item['price']
         subtotal = amount_each * quantity
         total += subtotal
         item_lines.append(f"- {name} x{quantity} = {subtotal:.2f} kr.")
 
+    if amount_paid is not None and amount_paid - total >= 0.01:
+        item_lines.append(f"- Tip = {amount_paid - total:.2f} kr.")
+        total = amount_paid
+
     items_text = "\n".join(item_lines)
 
     body = f"""
@@ -49,17 +79,4 @@ def send_order_confirmation(to_email, order, line_items):
     Best regards,
     jamnaw
     """
-
-    msg = MIMEMultipart()
-    msg["From"] = from_email
-    msg["To"] = to_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain"))
-
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(from_email, password)
-            server.send_message(msg)
-        print("Confirmation email sent.")
-    except Exception as e:
-        print(f"Failed to send email: {e}")
\ No newline at end of file
+    return subject, body
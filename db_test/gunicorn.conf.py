@@ -0,0 +1,54 @@
+from gunicorn.glogging import Logger
+import os
+import re
+
+# Gunicorn settings, see https://docs.gunicorn.org/en/stable/settings.html
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("GUNICORN_WORKERS", 10))
+
+# "gevent" runs every request in a greenlet, so blocking Postgres, Stripe, Azure Blob
+# and SMTP calls yield to other requests instead of holding the whole worker. "sync"
+# serves one request per worker at a time, and every open /orders/stream holds a worker
+# for as long as the client stays connected.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+# Concurrent clients per gevent worker
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "debug")
+errorlog = "-"
+accesslog = "-"
+
+# Query parameters whose values are kept out of the access log
+SECRET_QUERY_PARAMS = re.compile(r"\b(apikey)=[^&\s]*", re.IGNORECASE)
+
+
+class AccessLogger(Logger):
+    """Masks secrets passed in the query string, such as the API key /orders/stream takes
+    as ?apikey= because browsers cannot set headers on an EventSource."""
+
+    def atoms(self, resp, req, environ, request_time):
+        atoms = super().atoms(resp, req, environ, request_time)
+        return {key: SECRET_QUERY_PARAMS.sub(r"\1=[redacted]", value) if isinstance(value, str) else value
+                for key, value in atoms.items()}
+
+
+logger_class = AccessLogger
+
+
+def post_fork(server, worker):
+    if worker_class == "gevent":
+        # psycopg2 is a C extension, so it has to be told to wait through the gevent hub
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    # Each worker builds its restaurant spatial index before taking requests. This runs
+    # after gevent has patched the worker, so the index's listener thread is cooperative.
+    from spatial_index import get_spatial_index
+    try:
+        get_spatial_index().load()
+    except Exception:
+        # An exception here would stop the whole server. The index loads on its first
+        # lookup instead, by when the database may be reachable again.
+        worker.log.exception("Could not load the spatial index, deferring to the first request")
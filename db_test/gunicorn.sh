@@ -1,4 +1,4 @@
 #!/bin/bash
 
-# Run Gunicorn with 4 workers
-exec gunicorn --workers 4 --bind 0.0.0.0:8000 app:app
+# Run Gunicorn with the settings in gunicorn.conf.py (worker count and class come from the environment)
+exec gunicorn --config gunicorn.conf.py app:app
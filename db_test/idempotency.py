@@ -0,0 +1,72 @@
+from flask import request, jsonify, make_response
+from database import query_db, insert_db, transaction
+from functools import wraps
+from psycopg2.extras import Json
+import hashlib
+import os
+
+# How long a stored response is replayed for a repeated Idempotency-Key
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+def idempotent(f):
+    """Replays the stored response when a request repeats its Idempotency-Key header.
+
+    The key is locked for the duration of the request, so concurrent duplicates
+    wait for the first one and then get its response instead of repeating the work.
+    Requests without the header run as before. Responses with a 5xx status are not
+    stored, so those can be retried.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({"message": "Idempotency-Key is too long"}), 400
+
+        endpoint = request.path
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+
+        with transaction():
+            query_db("SELECT pg_advisory_xact_lock(hashtext(%s))", args=(f"{endpoint}:{key}",))
+
+            stored = query_db("""
+                SELECT requestHash, statusCode, responseBody
+                FROM idempotencyKeys
+                WHERE endpoint = %s AND key = %s
+                AND createdAt > now() - make_interval(secs => %s)
+            """, args=(endpoint, key, IDEMPOTENCY_TTL_SECONDS), one=True)
+
+            if stored:
+                if stored['requesthash'] != request_hash:
+                    return jsonify({"message": "Idempotency-Key was already used with a different request"}), 422
+                response = make_response(jsonify(stored['responsebody']), stored['statuscode'])
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code < 500 and response.is_json:
+                # Expired keys are cleared a batch at a time, skipping rows other requests hold
+                insert_db("""
+                    DELETE FROM idempotencyKeys
+                    WHERE ctid IN (
+                        SELECT ctid FROM idempotencyKeys
+                        WHERE createdAt < now() - make_interval(secs => %s)
+                        LIMIT 100
+                        FOR UPDATE SKIP LOCKED
+                    )
+                """, args=(IDEMPOTENCY_TTL_SECONDS,))
+                insert_db("""
+                    INSERT INTO idempotencyKeys (endpoint, key, requestHash, statusCode, responseBody)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (endpoint, key) DO UPDATE
+                    SET requestHash = EXCLUDED.requestHash,
+                        statusCode = EXCLUDED.statusCode,
+                        responseBody = EXCLUDED.responseBody,
+                        createdAt = now()
+                """, args=(endpoint, key, request_hash, response.status_code, Json(response.get_json())))
+        return response
+    return decorated
+
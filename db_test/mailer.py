@@ -0,0 +1,183 @@
+"""Email outbox.
+
+Requests queue emails with `enqueue_email` inside their own transaction, and a
+separate worker process (`python mailer.py`) sends them over one persistent SMTP
+connection, retrying failures with exponential backoff.
+"""
+from database import DATABASE_URL, insert_db
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+import psycopg2
+import psycopg2.extras
+import os
+import select
+import smtplib
+import time
+import traceback
+
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 465))
+SMTP_SSL = os.environ.get("SMTP_SSL", "true").lower() in ("1", "true", "yes")
+SMTP_USER = os.environ.get("SMTP_USER", os.getenv("GOOGLE_MAIL"))
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", os.getenv("GOOGLE_PASSWORD"))
+MAIL_FROM = os.environ.get("MAIL_FROM", SMTP_USER)
+
+MAILER_BATCH_SIZE = int(os.environ.get("MAILER_BATCH_SIZE", 50))
+# Seconds between outbox checks when no NOTIFY wakes the worker up earlier
+MAILER_POLL_INTERVAL = float(os.environ.get("MAILER_POLL_INTERVAL", 30))
+MAILER_MAX_ATTEMPTS = int(os.environ.get("MAILER_MAX_ATTEMPTS", 8))
+# Retry delays are MAILER_BACKOFF_BASE * 2^(attempts - 1) seconds, capped at MAILER_BACKOFF_MAX
+MAILER_BACKOFF_BASE = int(os.environ.get("MAILER_BACKOFF_BASE", 30))
+MAILER_BACKOFF_MAX = int(os.environ.get("MAILER_BACKOFF_MAX", 3600))
+
+
+def enqueue_email(to_email, subject, body) -> int:
+    """Queues an email for the mailer worker. Returns the outbox ID.
+
+    Call inside the `transaction()` that makes the email true, so it is only
+    sent if that work commits.
+    """
+    outboxID = insert_db("""
+        INSERT INTO emailOutbox (toEmail, subject, body)
+        VALUES (%s, %s, %s)
+        RETURNING id
+    """, args=(to_email, subject, body))
+    insert_db("SELECT pg_notify('email_outbox', '')")
+    return outboxID
+
+
+class Mailer:
+    """Drains the email outbox over a persistent SMTP connection."""
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.con = None
+        self.smtp = None
+
+    def _connect_db(self):
+        self.con = psycopg2.connect(self.dsn, cursor_factory=psycopg2.extras.RealDictCursor)
+        with self.con.cursor() as cur:
+            cur.execute("LISTEN email_outbox")
+        self.con.commit()
+
+    def _connect_smtp(self):
+        self._close_smtp()
+        if SMTP_SSL:
+            self.smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
+        else:
+            self.smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+        if SMTP_USER and SMTP_PASSWORD:
+            self.smtp.login(SMTP_USER, SMTP_PASSWORD)
+
+    def _close_smtp(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except OSError:
+                pass
+            self.smtp = None
+
+    def _send(self, email):
+        msg = MIMEMultipart()
+        msg["From"] = MAIL_FROM
+        msg["To"] = email['toemail']
+        msg["Subject"] = email['subject']
+        msg.attach(MIMEText(email['body'], "plain"))
+
+        if self.smtp is None:
+            self._connect_smtp()
+        try:
+            self.smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server drops idle connections, so reconnect once before giving up
+            self._connect_smtp()
+            self.smtp.send_message(msg)
+
+    def send_batch(self) -> int:
+        """Sends up to MAILER_BATCH_SIZE due emails. Returns how many were claimed.
+
+        Claimed rows stay locked until the batch commits, so several workers can
+        drain the outbox without sending an email twice.
+        """
+        with self.con.cursor() as cur:
+            cur.execute("""
+                SELECT id, toEmail, subject, body, attempts
+                FROM emailOutbox
+                WHERE sentAt IS NULL
+                AND attempts < %s
+                AND nextAttemptAt <= now()
+                ORDER BY nextAttemptAt
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (MAILER_MAX_ATTEMPTS, MAILER_BATCH_SIZE))
+            emails = cur.fetchall()
+
+            for email in emails:
+                # Any failure is recorded on its own row, so the batch still commits and the
+                # emails already delivered in it are not sent again
+                try:
+                    self._send(email)
+                except Exception as e:
+                    attempts = email['attempts'] + 1
+                    delay = min(MAILER_BACKOFF_BASE * 2 ** (attempts - 1), MAILER_BACKOFF_MAX)
+                    if not isinstance(e, OSError):
+                        # Not a delivery problem (e.g. an address or header that cannot be
+                        # encoded), so retrying will not help. The SMTP session may have been
+                        # left halfway through a message, so start a fresh one.
+                        attempts = MAILER_MAX_ATTEMPTS
+                        self._close_smtp()
+                    elif isinstance(e, smtplib.SMTPRecipientsRefused):
+                        # Retrying will not make the address valid
+                        attempts = MAILER_MAX_ATTEMPTS
+                    cur.execute("""
+                        UPDATE emailOutbox
+                        SET attempts = %s, nextAttemptAt = now() + make_interval(secs => %s), lastError = %s
+                        WHERE id = %s
+                    """, (attempts, delay, str(e), email['id']))
+                    print(f"Failed to send email {email['id']} (attempt {attempts}): {e!r}")
+                else:
+                    cur.execute("UPDATE emailOutbox SET sentAt = now() WHERE id = %s", (email['id'],))
+        self.con.commit()
+        return len(emails)
+
+    def wait(self, timeout):
+        """Blocks until an email is queued or `timeout` seconds pass."""
+        if self.con.notifies:
+            # Queued while the last batch was being sent
+            self.con.notifies.clear()
+            return
+        if select.select([self.con], [], [], timeout) != ([], [], []):
+            self.con.poll()
+            self.con.notifies.clear()
+
+    def run(self):
+        while True:
+            try:
+                if self.con is None or self.con.closed:
+                    self._connect_db()
+                # Keep going while batches come back full, then sleep until notified
+                while self.send_batch() >= MAILER_BATCH_SIZE:
+                    pass
+                self.wait(MAILER_POLL_INTERVAL)
+            except psycopg2.Error as e:
+                print(f"Mailer lost its database connection, reconnecting: {e}")
+                if self.con is not None:
+                    self.con.close()
+                self.con = None
+                time.sleep(5)
+            except Exception:
+                # Nothing may stop the worker. Rolling back releases the batch's claims,
+                # and the SMTP connection is opened again for the next one.
+                traceback.print_exc()
+                if self.con is not None and not self.con.closed:
+                    try:
+                        self.con.rollback()
+                    except psycopg2.Error:
+                        self.con.close()
+                        self.con = None
+                self._close_smtp()
+                time.sleep(5)
+
+
+if __name__ == "__main__":
+    Mailer(DATABASE_URL).run()
@@ -0,0 +1,84 @@
+"""Database maintenance.
+
+Moves completed and paid orders into the monthly archive partitions, creates
+the partitions for the coming months ahead of time and clears old login
+throttle counts. Run it from cron, or set
+MAINTENANCE_INTERVAL to keep it running and repeat every that many seconds.
+"""
+from database import DATABASE_URL
+import psycopg2
+import os
+import time
+
+# Completed and paid orders are archived once they were placed this many hours ago
+ARCHIVE_AFTER_HOURS = int(os.environ.get("ARCHIVE_AFTER_HOURS", 24))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 1000))
+ARCHIVE_MONTHS_AHEAD = int(os.environ.get("ARCHIVE_MONTHS_AHEAD", 3))
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", 0))
+
+
+def create_partitions(con, months_ahead):
+    """Creates the archive partitions from this month to `months_ahead` months out."""
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT create_order_archive_partition((date_trunc('month', now()) + make_interval(months => m))::DATE)
+            FROM generate_series(0, %s) m
+        """, (months_ahead,))
+    con.commit()
+
+
+def archive_orders(con, older_than_hours, batch_size) -> int:
+    """Archives finished orders a batch per transaction, so locks stay short.
+    Returns the number of orders archived."""
+    archived = 0
+    while True:
+        with con.cursor() as cur:
+            cur.execute("SELECT archive_orders(make_interval(hours => %s), %s)", (older_than_hours, batch_size))
+            moved = cur.fetchone()[0]
+        con.commit()
+        archived += moved
+        if moved < batch_size:
+            return archived
+
+
+def vacuum_hot_tables(con):
+    """Reclaims the space archived rows left in the live tables."""
+    con.autocommit = True
+    try:
+        with con.cursor() as cur:
+            cur.execute("VACUUM (ANALYZE) orders, OrderIncludesMenuItem")
+    finally:
+        con.autocommit = False
+
+
+def purge_login_throttle(con):
+    """Deletes login throttle counts whose window ended a day ago."""
+    with con.cursor() as cur:
+        cur.execute("DELETE FROM loginThrottle WHERE windowStart < now() - INTERVAL '1 day'")
+    con.commit()
+
+
+def run_once():
+    con = psycopg2.connect(DATABASE_URL)
+    try:
+        create_partitions(con, ARCHIVE_MONTHS_AHEAD)
+        archived = archive_orders(con, ARCHIVE_AFTER_HOURS, ARCHIVE_BATCH_SIZE)
+        if archived:
+            vacuum_hot_tables(con)
+        purge_login_throttle(con)
+        print(f"Archived {archived} orders")
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    while True:
+        try:
+            run_once()
+        except psycopg2.Error as e:
+            print(f"Maintenance failed: {e}")
+            if not MAINTENANCE_INTERVAL:
+                raise
+        if not MAINTENANCE_INTERVAL:
+            break
+        time.sleep(MAINTENANCE_INTERVAL)
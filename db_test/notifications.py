@@ -0,0 +1,182 @@
+import psycopg2
+from psycopg2 import sql
+from database import DATABASE_URL
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+# Events buffered per subscriber before new ones are dropped for that subscriber
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get("SUBSCRIBER_QUEUE_SIZE", 100))
+# Seconds subscribe() waits for the LISTEN on a new channel to be issued
+LISTEN_TIMEOUT = float(os.environ.get("LISTEN_TIMEOUT", 5))
+
+
+class Listener:
+    """One LISTEN connection per worker process, dispatching NOTIFY payloads to callbacks.
+
+    The connection lives on a background thread and is re-established if it drops.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pid = os.getpid()
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        # Channels the current connection has issued LISTEN for, and that connection's
+        # number, which changes on every reconnect
+        self._listening = set()
+        self._connection = 0
+        self._listened = threading.Condition(self._lock)
+        # Written to by subscribe() to wake the listener thread up for a new channel
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+
+    def subscribe(self, channel, callback):
+        """Calls `callback(payload)` for every notification on `channel`.
+
+        Returns once the channel is listened to, so notifications sent after subscribing
+        are not missed, or after LISTEN_TIMEOUT seconds if the database is unreachable.
+        Returns whether the channel is listened to."""
+        with self._lock:
+            self._callbacks.setdefault(channel, []).append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+                self._thread.start()
+            if channel in self._listening:
+                return True
+        os.write(self._wakeup_write, b"\0")
+        return self.wait(channel)
+
+    def wait(self, channel):
+        """Blocks until `channel`, which must have a callback, is listened to, for at most
+        LISTEN_TIMEOUT seconds. Returns whether it is."""
+        with self._lock:
+            return self._listened.wait_for(lambda: channel in self._listening, LISTEN_TIMEOUT)
+
+    def listening(self, channel):
+        """The number of the connection listening to `channel`, or None while none is.
+        Notifications may have been missed whenever the number changes."""
+        with self._lock:
+            return self._connection if channel in self._listening else None
+
+    def unsubscribe(self, channel, callback):
+        with self._lock:
+            callbacks = self._callbacks.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._callbacks.get(channel, []))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f"Notification callback failed on {channel}: {e}")
+
+    def _listen(self):
+        con = psycopg2.connect(self.dsn)
+        con.autocommit = True
+        with self._lock:
+            self._connection += 1
+        try:
+            while True:
+                with self._lock:
+                    channels = set(self._callbacks) - self._listening
+                for channel in channels:
+                    with con.cursor() as cur:
+                        cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                    with self._lock:
+                        self._listening.add(channel)
+                        self._listened.notify_all()
+
+                readable, _, _ = select.select([con, self._wakeup_read], [], [])
+                if self._wakeup_read in readable:
+                    os.read(self._wakeup_read, 4096)
+                if con not in readable:
+                    continue
+                con.poll()
+                while con.notifies:
+                    notify = con.notifies.pop(0)
+                    self._dispatch(notify.channel, notify.payload)
+        finally:
+            with self._lock:
+                self._listening.clear()
+            con.close()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error as e:
+                print(f"Notification listener lost its connection, reconnecting: {e}")
+                time.sleep(1)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    """Returns this process' listener, creating it after a fork."""
+    global _listener
+    if _listener is None or _listener.pid != os.getpid():
+        with _listener_lock:
+            if _listener is None or _listener.pid != os.getpid():
+                _listener = Listener(DATABASE_URL)
+    return _listener
+
+
+class OrderFeed:
+    """Fans the order_events channel out to per-restaurant subscriber queues."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._listening_pid = None
+
+    def subscribe(self, restaurantID):
+        """Returns a queue that receives the restaurant's order events as dicts, once the
+        order_events channel is listened to (or LISTEN_TIMEOUT seconds have passed)."""
+        first = False
+        if self._listening_pid != os.getpid():
+            with self._lock:
+                first = self._listening_pid != os.getpid()
+                if first:
+                    self._subscribers = {}
+                    self._listening_pid = os.getpid()
+        # Outside the lock, which publish and the other subscribers need meanwhile
+        if first:
+            get_listener().subscribe("order_events", self.publish)
+        else:
+            # The first subscriber's LISTEN may still be on its way
+            get_listener().wait("order_events")
+        events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(restaurantID, set()).add(events)
+        return events
+
+    def unsubscribe(self, restaurantID, events):
+        with self._lock:
+            subscribers = self._subscribers.get(restaurantID, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self._subscribers.pop(restaurantID, None)
+
+    def publish(self, payload):
+        event = json.loads(payload)
+        with self._lock:
+            subscribers = list(self._subscribers.get(event["restaurantId"], ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # A stalled client should not hold up the others
+                pass
+
+
+order_feed = OrderFeed()
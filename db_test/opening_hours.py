@@ -0,0 +1,48 @@
+from datetime import datetime
+import os
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    # Python 3.8
+    from backports.zoneinfo import ZoneInfo
+
+# Time zone the restaurants' opening and closing times are given in
+OPENING_HOURS_TIMEZONE = ZoneInfo(os.environ.get("OPENING_HOURS_TIMEZONE", "Europe/Copenhagen"))
+
+OPEN_FILTER_PARAMETERS = [{
+    'name': 'open_now',
+    'description': 'Only restaurants that are open right now (true/false)',
+    'in': 'query',
+    'type': 'boolean',
+    'required': False
+}, {
+    'name': 'open_at',
+    'description': 'Only restaurants open at this ISO 8601 time, e.g. 2025-06-01T21:30. '
+                   'Without a UTC offset it is taken as the restaurants\' local time.',
+    'in': 'query',
+    'type': 'string',
+    'required': False
+}]
+
+
+def minute_of_week(moment=None) -> int:
+    """Minutes since Monday 00:00 local time of `moment` (default now), as in restaurantOpeningHours."""
+    if moment is None:
+        moment = datetime.now(OPENING_HOURS_TIMEZONE)
+    elif moment.tzinfo is None:
+        moment = moment.replace(tzinfo=OPENING_HOURS_TIMEZONE)
+    local = moment.astimezone(OPENING_HOURS_TIMEZONE)
+    return local.weekday() * 1440 + local.hour * 60 + local.minute
+
+
+def requested_minute(args):
+    """The minute of week asked for with ?open_now or ?open_at, or None for no filter.
+    Raises ValueError if open_at is not an ISO 8601 time."""
+    open_at = args.get("open_at")
+    if open_at:
+        # fromisoformat only learned the Z suffix in Python 3.11
+        return minute_of_week(datetime.fromisoformat(open_at.replace("Z", "+00:00")))
+    if args.get("open_now", "").lower() in ("1", "true", "yes"):
+        return minute_of_week()
+    return None
@@ -0,0 +1,75 @@
+"""Password hashing off the request path.
+
+bcrypt is deliberately slow, so hashes run in a small per-worker process pool and at
+most PASSWORD_HASH_CONCURRENCY of them may be queued or running at once. Requests
+beyond that wait up to PASSWORD_HASH_WAIT seconds and then get PasswordHashingBusy
+instead of piling up behind a credential-stuffing burst. This module only imports
+bcrypt so the pool processes start quickly.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+import multiprocessing
+import os
+import threading
+
+PASSWORD_HASH_PROCESSES = int(os.environ.get("PASSWORD_HASH_PROCESSES", 2))
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", 8))
+PASSWORD_HASH_WAIT = float(os.environ.get("PASSWORD_HASH_WAIT", 5))
+# Same default cost as Flask-Bcrypt, so existing hashes keep verifying at the same speed
+BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed_password, password):
+    try:
+        return bcrypt.checkpw(password.encode(), hashed_password.encode())
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = None
+
+
+def _get_executor():
+    global _executor, _executor_pid, _slots
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                # Spawned rather than forked, so the pool never inherits a worker's
+                # connections, threads or gevent hub
+                _executor = ProcessPoolExecutor(PASSWORD_HASH_PROCESSES,
+                                                mp_context=multiprocessing.get_context("spawn"))
+                _slots = threading.BoundedSemaphore(PASSWORD_HASH_CONCURRENCY)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _run(fn, *args):
+    executor = _get_executor()
+    if not _slots.acquire(timeout=PASSWORD_HASH_WAIT):
+        raise PasswordHashingBusy()
+    try:
+        return executor.submit(fn, *args).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password) -> str:
+    """Returns the bcrypt hash of `password`."""
+    return _run(_hash, password, BCRYPT_LOG_ROUNDS)
+
+
+def check_password(hashed_password, password) -> bool:
+    """Returns True if `password` matches the stored bcrypt hash."""
+    return _run(_check, hashed_password, password)
@@ -1,10 +1,16 @@
 from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from database import query_db, insert_db, transaction
 from flasgger import swag_from
-from flask_jwt_extended import create_access_token
-from extensions import bcrypt
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt, get_jwt_identity
+from passwords import hash_password, check_password, PasswordHashingBusy
+import hashlib
 import os
 
+# Login attempts allowed per email and per client address in each throttle window
+LOGIN_THROTTLE_WINDOW = int(os.environ.get("LOGIN_THROTTLE_WINDOW", 300))
+LOGIN_MAX_ATTEMPTS_PER_EMAIL = int(os.environ.get("LOGIN_MAX_ATTEMPTS_PER_EMAIL", 5))
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.environ.get("LOGIN_MAX_ATTEMPTS_PER_IP", 50))
+
 admin_users_blueprint = Blueprint('admin_users', __name__)
 
 @admin_users_blueprint.route('/adminUsers/<int:adminID>', methods=["GET"])
@@ -70,7 +76,10 @@ def add_admin_user():
         return jsonify({"error": "Missing required fields"}), 400
 
     # Hashing the password for secure sotrage.
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    try:
+        hashed_password = hash_password(password)
+    except PasswordHashingBusy:
+        return jsonify({"error": "Server busy, try again shortly"}), 503, {"Retry-After": "1"}
 
 
     insert_db("INSERT INTO adminuser (name, email, password) VALUES (%s, %s, %s)", args=(name, email, hashed_password))
@@ -95,8 +104,10 @@ def add_admin_user():
         }
     }],
     'responses': {
-        200: {'description': 'Login successful, JWT token returned'},
-        401: {'description': 'Invalid credentials'}
+        200: {'description': 'Login successful, a short-lived access token and a refresh token returned'},
+        401: {'description': 'Invalid credentials'},
+        429: {'description': 'Too many login attempts for this email or address, see Retry-After'},
+        503: {'description': 'Too many logins in progress, see Retry-After'}
     }
 })
 def admin_login():
@@ -104,15 +115,83 @@ def admin_login():
     email = data.get("email")
     password = data.get("password")
 
+    if not email or not password:
+        return jsonify({"error": "email or password may be incorrect"}), 401
+
+    # Throttled before bcrypt runs, so a burst of guesses costs no hashing
+    retry_after = throttle_login(email, request.remote_addr)
+    if retry_after:
+        return jsonify({"error": "Too many login attempts, try again later"}), 429, {"Retry-After": str(retry_after)}
+
     user = query_db("SELECT id, password FROM AdminUser WHERE email = %s", args=(email,), one=True)
 
-    print(data)
-    print(user)
-    if not user or not bcrypt.check_password_hash(user['password'], password):
-        return jsonify({"error": "email or password may be incorrect"}), 401
+    try:
+        if not user or not check_password(user['password'], password):
+            return jsonify({"error": "email or password may be incorrect"}), 401
+    except PasswordHashingBusy:
+        return jsonify({"error": "Server busy, try again shortly"}), 503, {"Retry-After": "1"}
+
+    insert_db("DELETE FROM loginThrottle WHERE key = %s", args=("email:" + email.lower(),))
+
+    # 🔹 Generate JWT tokens
+    identity = {"id": user["id"], "email": email}
+    access_token = create_access_token(identity=identity)
+    refresh_token = create_refresh_token(identity=identity,
+                                         additional_claims={"pwd": password_fingerprint(user['password'])})
+    return jsonify(access_token=access_token, refresh_token=refresh_token), 200
+
+
+def throttle_login(email, address):
+    """Counts a login attempt against the email and the client address.
+    Returns the seconds until another attempt is allowed, or 0 if this one may proceed."""
+    with transaction():
+        counts = query_db("""
+            INSERT INTO loginThrottle (key, maxAttempts)
+            VALUES (%s, %s), (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET
+                attempts = CASE WHEN loginThrottle.windowStart < now() - make_interval(secs => %s)
+                                THEN 1 ELSE loginThrottle.attempts + 1 END,
+                windowStart = CASE WHEN loginThrottle.windowStart < now() - make_interval(secs => %s)
+                                   THEN now() ELSE loginThrottle.windowStart END,
+                maxAttempts = EXCLUDED.maxAttempts
+            RETURNING attempts > maxAttempts AS throttled,
+                      ceil(extract(epoch FROM windowStart + make_interval(secs => %s) - now()))::INTEGER AS retryAfter
+        """, args=("email:" + email.lower(), LOGIN_MAX_ATTEMPTS_PER_EMAIL,
+                    "ip:" + (address or "unknown"), LOGIN_MAX_ATTEMPTS_PER_IP,
+                    LOGIN_THROTTLE_WINDOW, LOGIN_THROTTLE_WINDOW, LOGIN_THROTTLE_WINDOW))
+    return max([count['retryafter'] for count in counts if count['throttled']] or [0])
+
+
+def password_fingerprint(hashed_password):
+    """Short digest of the stored password hash. Refresh tokens carry it, so changing
+    the password invalidates them."""
+    return hashlib.sha256(hashed_password.encode()).hexdigest()[:16]
+
+
+@admin_users_blueprint.route('/adminUsers/refresh', methods=["POST"])
+@jwt_required(refresh=True)
+@swag_from({
+    'tags': ['Admin Users'],
+    'description': 'Get a new access token with a refresh token, without logging in again',
+    'parameters': [{
+        'name': 'Authorization',
+        'in': 'header',
+        'description': 'The refresh token (Bearer token format)',
+        'required': True,
+        'type': 'string'
+    }],
+    'responses': {
+        200: {'description': 'New access token returned'},
+        401: {'description': 'The admin user was deleted or changed password since the refresh token was issued'}
+    }
+})
+def refresh_admin_token():
+    identity = get_jwt_identity()
+    user = query_db("SELECT password FROM AdminUser WHERE id = %s", args=(identity["id"],), one=True)
+    if not user or get_jwt().get("pwd") != password_fingerprint(user['password']):
+        return jsonify({"error": "Refresh token is no longer valid"}), 401
 
-    # 🔹 Generate JWT token
-    access_token = create_access_token(identity={"id": user["id"], "email": email})
+    access_token = create_access_token(identity=identity)
     return jsonify(access_token=access_token), 200
 
 
@@ -160,7 +239,10 @@ def update_admin_user(adminID):
     if not existing_user:
         return jsonify({"error": "Admin user not found"}), 404
 
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    try:
+        hashed_password = hash_password(password)
+    except PasswordHashingBusy:
+        return jsonify({"error": "Server busy, try again shortly"}), 503, {"Retry-After": "1"}
 
     insert_db("UPDATE adminuser SET name = %s, email = %s, password = %s WHERE id = %s", args=(name, email, hashed_password, adminID))
     return jsonify({"message": "Admin user updated successfully"}), 200
@@ -1,10 +1,9 @@
 from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from database import query_db, insert_db, transaction
+from api_key_auth import hash_api_key, invalidate
 from flasgger import swag_from
 from flask_jwt_extended import jwt_required
 import secrets
-from extensions import bcrypt
-import hashlib
 
 
 api_keys_blueprint = Blueprint('api_keys', __name__)
@@ -37,7 +36,7 @@ def add_api_key():
     restaurantID = data.get("restaurantID")
     apikey = generate_api_key()
 
-    hashed_key = hashlib.sha256(apikey.encode()).hexdigest()
+    hashed_key = hash_api_key(apikey)
 
     if not restaurantID:
         return jsonify({"error": "Missing required fields"}), 400
@@ -46,9 +45,48 @@ def add_api_key():
     return jsonify({"message": apikey}), 201
 
 
-def validate_api_key(apikey, restaurantID):
-    keys = query_db("SELECT * FROM apikeys WHERE restaurantID = %s", args=(restaurantID,))
-    for key in keys:
-        if bcrypt.check_password_hash(key['apikey'], apikey):
-            return True
-    return False
+@api_keys_blueprint.route('/apiKeys/revoke', methods=["POST"])
+@jwt_required()
+@swag_from({
+    'tags': ['API Keys'],
+    'parameters': [{
+        'in': 'body',
+        'name': 'body',
+        'required': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'apiKey': {
+                    'type': 'string',
+                    'description': 'The API key to revoke'
+                }
+            }
+        }
+    }],
+    'responses': {
+        200: {
+            'description': 'API key revoked'
+        },
+        400: {
+            'description': 'Missing required fields'
+        },
+        404: {
+            'description': 'API key not found'
+        }
+    }
+})
+def revoke_api_key():
+    data = request.get_json()
+    apikey = data.get("apiKey")
+    if not apikey:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    hashed_key = hash_api_key(apikey)
+    with transaction():
+        revoked = query_db("DELETE FROM apikeys WHERE apikey = %s RETURNING restaurantID", args=(hashed_key,), one=True)
+        if revoked:
+            invalidate(hashed_key)
+
+    if not revoked:
+        return jsonify({"error": "API key not found"}), 404
+    return jsonify({"message": "API key revoked"}), 200
@@ -0,0 +1,189 @@
+from flask import Blueprint, jsonify, request
+from database import pool_stats, prepared_statement_stats, measure_planning, slow_query_stats, timeout_class
+from flasgger import swag_from
+import os
+
+diagnostics_blueprint = Blueprint('diagnostics', __name__)
+
+
+@diagnostics_blueprint.route("/db/poolStats", methods=["GET"])
+@swag_from({
+    'tags': ['Diagnostics'],
+    'summary': 'Connection pool metrics for the worker serving the request',
+    'parameters': [
+        {
+            'name': 'Authorization',
+            'in': 'header',
+            'description': 'Admin key (Bearer token format)',
+            'required': True,
+            'type': 'string'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Pool size and saturation counters',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'idle': {'type': 'integer'},
+                    'in_use': {'type': 'integer'},
+                    'max': {'type': 'integer'},
+                    'saturation': {'type': 'number'},
+                    'checkouts': {'type': 'integer'},
+                    'waits': {'type': 'integer'},
+                    'wait_ms': {'type': 'number'},
+                    'timeouts': {'type': 'integer'},
+                    'connects': {'type': 'integer'},
+                    'discards': {'type': 'integer'}
+                }
+            }
+        },
+        400: {
+            'description': 'Wrong admin key'
+        }
+    }
+})
+def get_pool_stats():
+    auth_header = request.headers.get("Authorization")
+    key = auth_header.split(" ")[1]
+    storedkey = os.getenv("ADMINKEY")
+    if key != storedkey:
+        return jsonify({"message": "Wrong key"}), 400
+
+    return jsonify(dict(pool_stats(), pid=os.getpid()))
+
+
+@diagnostics_blueprint.route("/db/preparedStatements", methods=["GET"])
+@swag_from({
+    'tags': ['Diagnostics'],
+    'summary': 'Prepared statements registered in this worker and how often they ran',
+    'parameters': [
+        {
+            'name': 'Authorization',
+            'in': 'header',
+            'description': 'Admin key (Bearer token format)',
+            'required': True,
+            'type': 'string'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Executions per prepared statement'
+        },
+        400: {
+            'description': 'Wrong admin key'
+        }
+    }
+})
+def get_prepared_statements():
+    auth_header = request.headers.get("Authorization")
+    key = auth_header.split(" ")[1]
+    storedkey = os.getenv("ADMINKEY")
+    if key != storedkey:
+        return jsonify({"message": "Wrong key"}), 400
+
+    return jsonify(prepared_statement_stats())
+
+
+@diagnostics_blueprint.route("/db/preparedStatements/<name>/planning", methods=["POST"])
+@timeout_class("admin")
+@swag_from({
+    'tags': ['Diagnostics'],
+    'summary': 'Measure the planning time a prepared statement saves',
+    'description': 'Runs EXPLAIN on the statement both as plain SQL and through its prepared plan, with the given arguments.',
+    'parameters': [
+        {
+            'name': 'Authorization',
+            'in': 'header',
+            'description': 'Admin key (Bearer token format)',
+            'required': True,
+            'type': 'string'
+        },
+        {
+            'name': 'name',
+            'in': 'path',
+            'description': 'Name of the prepared statement',
+            'required': True,
+            'type': 'string'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'args': {
+                        'type': 'array',
+                        'description': 'Arguments for the statement placeholders',
+                        'items': {}
+                    }
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Planning time with and without the prepared plan'
+        },
+        400: {
+            'description': 'Wrong admin key'
+        },
+        404: {
+            'description': 'No prepared statement with that name'
+        }
+    }
+})
+def measure_prepared_statement(name):
+    auth_header = request.headers.get("Authorization")
+    key = auth_header.split(" ")[1]
+    storedkey = os.getenv("ADMINKEY")
+    if key != storedkey:
+        return jsonify({"message": "Wrong key"}), 400
+
+    if name not in prepared_statement_stats():
+        return jsonify({"error": "Prepared statement not found"}), 404
+
+    data = request.get_json() or {}
+    return jsonify(measure_planning(name, tuple(data.get("args", []))))
+
+
+@diagnostics_blueprint.route("/db/slowQueries", methods=["GET"])
+@swag_from({
+    'tags': ['Diagnostics'],
+    'summary': 'Slowest statements seen by the worker serving the request',
+    'description': 'Statements slower than DB_SLOW_QUERY_MS, ordered by total time, with the latest captured EXPLAIN (ANALYZE, BUFFERS) plan.',
+    'parameters': [
+        {
+            'name': 'Authorization',
+            'in': 'header',
+            'description': 'Admin key (Bearer token format)',
+            'required': True,
+            'type': 'string'
+        },
+        {
+            'name': 'limit',
+            'in': 'query',
+            'description': 'Number of statements to return (default 20)',
+            'required': False,
+            'type': 'integer'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Slow statements with count, total_ms, max_ms, args_fingerprint and plan'
+        },
+        400: {
+            'description': 'Wrong admin key'
+        }
+    }
+})
+def get_slow_queries():
+    auth_header = request.headers.get("Authorization")
+    key = auth_header.split(" ")[1]
+    storedkey = os.getenv("ADMINKEY")
+    if key != storedkey:
+        return jsonify({"message": "Wrong key"}), 400
+
+    limit = request.args.get("limit", 20, type=int)
+    return jsonify(slow_query_stats(limit))
@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from database import query_db, insert_db, prepare_statement, query_prepared
 from flasgger import swag_from
 from flask_jwt_extended import jwt_required
 from azure.storage.blob import BlobServiceClient
@@ -78,6 +78,19 @@ def get_menu_item(itemID):
     return jsonify(request_data)
 
 
+prepare_statement("menu_items_by_section", """
+    SELECT
+        menuitem.*,
+        json_agg(t) AS tags
+    FROM
+    menuitem
+    LEFT JOIN menuitemhastag mit ON menuitem.id = mit.menuitemid
+    LEFT JOIN tag t ON mit.tagid = t.id
+    WHERE sectionID = %s
+    GROUP BY menuitem.id
+    """)
+
+
 @menu_items_blueprint.route('/menuItems/section/<sectionID>', methods=["GET"])
 @swag_from({
     'tags': ['Menu Items'],
@@ -93,17 +106,7 @@ def get_menu_item(itemID):
     ]
 })
 def get_menu_items_by_section(sectionID):
-    request_data = query_db(""" SELECT
-                                    menuitem.*,
-                                    json_agg(t) AS tags
-                                FROM
-                                menuitem
-                                LEFT JOIN menuitemhastag mit ON menuitem.id = mit.menuitemid
-                                LEFT JOIN tag t ON mit.tagid = t.id
-                                WHERE sectionID = %s
-                                GROUP BY menuitem.id
-                            """,
-                            args=(sectionID,))
+    request_data = query_prepared("menu_items_by_section", args=(sectionID,))
     return jsonify(request_data)
 
 
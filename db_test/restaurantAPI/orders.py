@@ -1,20 +1,85 @@
-from flask import Blueprint, request, jsonify
-from database import query_db, insert_db
+from flask import Blueprint, request, jsonify, Response, g
+from database import query_db, insert_db, transaction, prepare_statement, query_prepared, use_primary, release_connections
+from notifications import order_feed
+from idempotency import idempotent
+from api_key_auth import require_api_key
 from flasgger import swag_from
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from extensions import bcrypt, decrypt, send_order_confirmation
+from extensions import bcrypt, decrypt, build_order_confirmation
+from mailer import enqueue_email
+from stripe_clients import get_stripe_client
 import stripe 
+import psycopg2.errors
 import os
-import hashlib
+import json
+import queue
+import time
 
 orders_blueprint = Blueprint('orders', __name__)
 
+# Seconds between keep-alive comments on an idle order stream
+ORDER_STREAM_KEEPALIVE = int(os.environ.get("ORDER_STREAM_KEEPALIVE", 15))
+# Longest a paymentStatus call may wait for the payment to arrive
+PAYMENT_STATUS_MAX_WAIT = int(os.environ.get("PAYMENT_STATUS_MAX_WAIT", 25))
+
+
+prepare_statement("orders_by_restaurant", """
+    SELECT
+        o.*,
+        json_agg(to_jsonb(mi.*) || jsonb_build_object('quantity', oim.quantity, 'unitprice', oim.unitPrice)) AS menuItems
+    FROM orders o
+    LEFT JOIN orderincludesmenuitem oim ON oim.orderID = o.id
+    LEFT JOIN menuitem mi ON oim.menuItemID = mi.id
+    WHERE o.restaurantID = %s
+    AND orderComplete = false
+    GROUP BY o.id
+    """)
+
+
+# Open orders changed since a cursor, plus completed ones as tombstones without their items.
+# A since of 0 is an initial sync and skips the completed orders. The archive watermark, the
+# next cursor and the changes are read in one statement, so they share one snapshot: every
+# order committed after it has a changeXid at or above the cursor, and an archive run cannot
+# slip in between checking the watermark and reading the orders. Orders archived since the
+# given cursor took their tombstones with them, so the sync starts over from 0 (sync_reset).
+# The state columns come on every row, and on a single row without an order if none changed.
+prepare_statement("orders_changed_since", """
+    WITH sync AS (
+        SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS sync_cursor, reset AS sync_reset,
+            CASE WHEN reset THEN '0'::xid8 ELSE since END AS since
+        FROM (SELECT %s::xid8 AS since) args
+        CROSS JOIN orderArchiveWatermark
+        CROSS JOIN LATERAL (SELECT since > '0'::xid8 AND since <= changeXid AS reset) archived
+    )
+    SELECT sync.sync_cursor, sync.sync_reset, o.*, items.menuItems
+    FROM sync
+    LEFT JOIN orders o ON o.restaurantID = %s
+        AND o.changeXid >= sync.since
+        AND (NOT o.orderComplete OR sync.since > '0'::xid8)
+    LEFT JOIN LATERAL (
+        SELECT json_agg(to_jsonb(mi.*) || jsonb_build_object('quantity', oim.quantity, 'unitprice', oim.unitPrice)) AS menuItems
+        FROM orderincludesmenuitem oim
+        JOIN menuitem mi ON oim.menuItemID = mi.id
+        WHERE oim.orderID = o.id
+    ) items ON NOT o.orderComplete
+    """)
+
+# Bookkeeping columns of orders that are not part of the API
+INTERNAL_ORDER_COLUMNS = ("changexid", "sync_cursor", "sync_reset")
+
+
+def public_order(order):
+    """The order row without INTERNAL_ORDER_COLUMNS, as sent to clients."""
+    return {key: value for key, value in order.items() if key not in INTERNAL_ORDER_COLUMNS}
+
 
 @orders_blueprint.route('/orders/byrestaurant', methods=["GET"])
+@use_primary
+@require_api_key()
 @swag_from({
     'tags': ['Orders'],
     'summary': 'Get all orders for a specific restaurant',
-    'description': 'This endpoint retrieves all incomplete orders for a specific restaurant, based on the provided API key. The orders are grouped with their respective menu items.',
+    'description': 'This endpoint retrieves all incomplete orders for a specific restaurant, based on the provided API key. The orders are grouped with their respective menu items. With a since cursor it instead returns an object with the orders changed after the cursor, the IDs of orders completed since (removed), and the cursor to pass on the next call. If reset is true the cursor was too old, and orders holds every open order to replace the local list with.',
     'parameters': [
         {
             'name': 'Authorization',
@@ -23,6 +88,13 @@ orders_blueprint = Blueprint('orders', __name__)
             'required': True,
             'type': 'string',
             'example': 'Bearer YOUR_API_KEY'
+        },
+        {
+            'name': 'since',
+            'in': 'query',
+            'description': 'Cursor from the previous response. Use 0 for an initial sync of all open orders',
+            'required': False,
+            'type': 'string'
         }
     ],
     'responses': {
@@ -69,6 +141,14 @@ orders_blueprint = Blueprint('orders', __name__)
                                     'menuItemPrice': {
                                         'type': 'number',
                                         'description': 'The price of the menu item'
+                                    },
+                                    'quantity': {
+                                        'type': 'integer',
+                                        'description': 'How many of the menu item were ordered'
+                                    },
+                                    'unitprice': {
+                                        'type': 'number',
+                                        'description': 'The price of one menu item when the order was placed'
                                     }
                                 }
                             },
@@ -87,40 +167,86 @@ orders_blueprint = Blueprint('orders', __name__)
     }
 })
 def get_orders():
-    auth_header = request.headers.get("Authorization")
-    if not auth_header:
-        return jsonify({"error": "Missing authorization header"}), 401
+    since = request.args.get("since")
+    if since is None:
+        request_data = query_prepared("orders_by_restaurant", args=(g.restaurant_id,))
+        return jsonify([public_order(order) for order in request_data])
+
+    if not since.isdigit():
+        return jsonify({"error": "Invalid since cursor"}), 400
+
+    rows = query_prepared("orders_changed_since", args=(since, g.restaurant_id))
+    changes = [row for row in rows if row['id'] is not None]
+    return jsonify({
+        "orders": [public_order(order) for order in changes if not order['ordercomplete']],
+        "removed": [order['id'] for order in changes if order['ordercomplete']],
+        "cursor": rows[0]['sync_cursor'],
+        "reset": rows[0]['sync_reset']
+    })
 
-    try:
-        apikey = auth_header.split(" ")[1]
-    except IndexError:
-        return jsonify({"error": "Invalid authorization header format"}), 401
-
-    hashed_key = hashlib.sha256(apikey.encode()).hexdigest()
-
-    request_data = query_db("""
-    WITH restaurant AS (
-        SELECT restaurantID
-        FROM apikeys
-        WHERE apikey = %s 
-        LIMIT 1
-    )
-    SELECT
-        o.*,
-        json_agg(mi.*) AS menuItems
-    FROM orders o
-    LEFT JOIN orderincludesmenuitem oim ON oim.orderID = o.id
-    LEFT JOIN menuitem mi ON oim.menuItemID = mi.id
-    WHERE o.restaurantID = (SELECT restaurantID FROM restaurant)
-    AND orderComplete = false
-    GROUP BY o.id
-    """,
-    args=(hashed_key,)
-    )
-    return jsonify(request_data)
+
+@orders_blueprint.route('/orders/stream', methods=["GET"])
+@use_primary
+@require_api_key(query_param="apikey")
+@swag_from({
+    'tags': ['Orders'],
+    'summary': 'Live order events for a restaurant',
+    'description': 'Server-sent event stream of order events for the restaurant owning the API key. Sends a "created", "completed" or "paid" event as orders change, and a keep-alive comment while idle. Browsers cannot set headers on an EventSource, so the key may also be passed as the apikey query parameter.',
+    'produces': ['text/event-stream'],
+    'parameters': [
+        {
+            'name': 'Authorization',
+            'in': 'header',
+            'description': 'API key for the restaurant (Bearer token format)',
+            'required': False,
+            'type': 'string',
+            'example': 'Bearer YOUR_API_KEY'
+        },
+        {
+            'name': 'apikey',
+            'in': 'query',
+            'description': 'API key for the restaurant, if not given in the Authorization header',
+            'required': False,
+            'type': 'string'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Event stream. Each event carries orderId, restaurantId, tableId and orderCost as JSON'
+        },
+        401: {
+            'description': 'Unauthorized access - Missing or invalid API key'
+        }
+    }
+})
+def stream_orders():
+    restaurantID = g.restaurant_id
+
+    # The generator runs after the request has been torn down, so it must not touch the database.
+    # It only subscribes once the body is read, so a HEAD request or a client that is gone
+    # before the first chunk leaves no subscriber behind.
+    def generate():
+        events = order_feed.subscribe(restaurantID)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=ORDER_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            order_feed.unsubscribe(restaurantID, events)
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
 
 @orders_blueprint.route('/orders/byorderId/<orderId>/', methods=["GET"])
+@use_primary
 @swag_from({
     'tags': ['Orders'],
     'responses': {
@@ -155,13 +281,45 @@ def get_orders():
 def get_order(orderId):
     request_data = query_db("SELECT * FROM orders WHERE id = %s AND orderComplete = false"
                             , args=(orderId,))
-    return jsonify(request_data)
+    return jsonify([public_order(order) for order in request_data])
+
+
+prepare_statement("place_order", """
+    SELECT order_id, order_total FROM place_order(%s, %s, %s, %s, %s, %s)
+    """)
+
+
+def parse_order_lines(menuItems):
+    """Merges the requested menu items into parallel (menu item IDs, quantities) lists.
+    Items are {menuItemId, quantity} objects or bare IDs counting as one each.
+    Returns None if an item or quantity is invalid."""
+    quantities = {}
+    for item in menuItems:
+        if isinstance(item, dict):
+            menuItemId, quantity = item.get('menuItemId'), item.get('quantity', 1)
+        else:
+            menuItemId, quantity = item, 1
+        try:
+            menuItemId, quantity = int(menuItemId), int(quantity)
+        except (TypeError, ValueError):
+            return None
+        if quantity < 1:
+            return None
+        quantities[menuItemId] = quantities.get(menuItemId, 0) + quantity
+    return list(quantities), list(quantities.values())
 
 
 @orders_blueprint.route('/orders/add', methods=["POST"])
+@idempotent
 @swag_from({
 'tags': ['Orders'],
 'parameters': [{
+    'name': 'Idempotency-Key',
+    'in': 'header',
+    'description': 'Optional unique key for this order. Retrying with the same key returns the original response instead of placing the order again',
+    'required': False,
+    'type': 'string'
+}, {
     'in': 'body',
     'name': 'body',
     'required': True,
@@ -190,9 +348,19 @@ def get_order(orderId):
             },
             'menuItems': {
                 'type': 'array',
+                'description': 'The ordered menu items. A bare menu item ID counts as a quantity of 1',
                 'items': {
-                    'type': 'integer',
-                    'description': 'The ID of a menu item'
+                    'type': 'object',
+                    'properties': {
+                        'menuItemId': {
+                            'type': 'integer',
+                            'description': 'The ID of a menu item'
+                        },
+                        'quantity': {
+                            'type': 'integer',
+                            'description': 'How many of the menu item to order (default 1)'
+                        }
+                    }
                 }
             }
         }
@@ -200,48 +368,50 @@ def get_order(orderId):
 }],
 'responses': {
     201: {
-        'description': 'Order created'
+        'description': 'Order created, with its orderId and orderTotal'
     },
     400: {
         'description': 'Bad request'
+    },
+    404: {
+        'description': 'Restaurant, table or menu item not found'
+    },
+    422: {
+        'description': 'Idempotency-Key was already used with a different request'
     }},
 })
 def add_order():
-# TODO: Add better rollback for none existing menu items
     request_data = request.get_json()
     restaurantId = request_data['restaurantId']
     userId = request_data['userId']
     orderTable = request_data['orderTable']
     menuItems = request_data['menuItems']
     comments = request_data.get('comments', "no comments")
-    orderTotal = 0
-    for item in menuItems:
-        item_data = query_db("SELECT price FROM menuitem WHERE id = %s",
-                             args=(item,))
-        orderTotal += item_data[0]['price']
-        print(orderTotal)
-    
-    tables = query_db("SELECT totaltables FROM restaurant WHERE id = %s", args=(restaurantId,), one=True)
-    if not tables:
-        return jsonify({"message": "Restaurant not found"}), 404
-    
-    totaltables = tables['totaltables']
-    if orderTable > totaltables:
-        return jsonify({"message": "Table does not exist"}), 404
-    
-    orderID = insert_db("""INSERT INTO orders
-                        (restaurantId, userID, tableID, orderCost, orderComplete, orderTime, comments)
-                        VALUES (%s, %s, %s, %s, False, now(), %s)
-                        RETURNING id""",
-                        args=(restaurantId, userId, orderTable, orderTotal, comments))
 
-    for item in menuItems:
-        insert_db("INSERT INTO orderincludesmenuitem (orderID, menuItemID) VALUES (%s, %s)",
-                  args=(orderID, item))
+    lines = parse_order_lines(menuItems)
+    if lines is None:
+        return jsonify({"message": "Invalid menu item or quantity"}), 400
+    menuItemIds, quantities = lines
+
+    # place_order validates, prices and inserts the order and its items in one call
+    try:
+        with transaction():
+            order = query_prepared("place_order",
+                                   args=(restaurantId, userId, orderTable, comments, menuItemIds, quantities),
+                                   one=True)
+    except psycopg2.errors.NoDataFound as e:
+        return jsonify({"message": e.diag.message_primary}), 404
+
+    orderID = order['order_id']
+    return jsonify({
+        "message": f"Order created: {orderID}",
+        "orderId": orderID,
+        "orderTotal": order['order_total']
+    }), 201
 
-    return jsonify({"message": f"Order created: {orderID}"}), 201
 
 @orders_blueprint.route('/orders/markComplete/<orderID>/', methods=["PUT"])
+@require_api_key()
 @swag_from({
     'tags': ['Orders'],
     'parameters': [{
@@ -279,41 +449,134 @@ def add_order():
     }
 })
 def mark_order_complete(orderID):
-    auth_header = request.headers.get("Authorization")
-    if not auth_header:
-        return jsonify({"error": "Missing authorization header"}), 401
-
-    try:
-        apikey = auth_header.split(" ")[1]
-    except IndexError:
-        return jsonify({"error": "Invalid authorization header format"}), 401
+    with transaction():
+        completed = query_db("""
+            UPDATE orders
+            SET orderComplete = TRUE
+            WHERE id = %s AND restaurantID = %s
+            RETURNING id
+        """, args=(orderID, g.restaurant_id), one=True)
+
+    if not completed:
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify({"message": "Order marked as complete"}), 200
 
-    hashed_key = hashlib.sha256(apikey.encode()).hexdigest()
 
-    order_details = query_db("""
-        SELECT o.restaurantID
-        FROM orders o
-        WHERE o.id = %s
-    """, args=(orderID,), one=True)
+@orders_blueprint.route('/orders/markComplete', methods=["PUT"])
+@require_api_key()
+@swag_from({
+    'tags': ['Orders'],
+    'summary': 'Mark several orders as complete',
+    'description': 'Marks the given orders, or every open order at a table, as complete in one update. Only orders of the restaurant owning the API key are changed.',
+    'parameters': [
+        {
+            'name': 'Authorization',
+            'in': 'header',
+            'description': 'API key for the restaurant (Bearer token format)',
+            'required': True,
+            'type': 'string',
+            'example': 'Bearer YOUR_API_KEY'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'orderIds': {
+                        'type': 'array',
+                        'items': {'type': 'integer'},
+                        'description': 'IDs of the orders to mark as complete'
+                    },
+                    'tableId': {
+                        'type': 'integer',
+                        'description': 'Table number whose open orders to mark as complete, instead of orderIds'
+                    }
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Result per order: completed, alreadyComplete or notFound',
+            'examples': {
+                'application/json': {
+                    'results': [
+                        {'orderId': 1, 'status': 'completed'},
+                        {'orderId': 2, 'status': 'alreadyComplete'},
+                        {'orderId': 3, 'status': 'notFound'}
+                    ]
+                }
+            }
+        },
+        400: {
+            'description': 'Neither a list of orderIds nor a tableId was given'
+        },
+        401: {
+            'description': 'Unauthorized request due to incorrect API key or missing API key'
+        }
+    }
+})
+def mark_orders_complete():
+    restaurantID = g.restaurant_id
+
+    data = request.get_json(silent=True) or {}
+    orderIds = data.get('orderIds')
+    tableId = data.get('tableId')
+
+    if orderIds is None and tableId is not None:
+        try:
+            tableId = int(tableId)
+        except (TypeError, ValueError):
+            return jsonify({"message": "Invalid tableId"}), 400
+        with transaction():
+            completed = query_db("""
+                UPDATE orders
+                SET orderComplete = TRUE
+                WHERE restaurantID = %s AND tableID = %s AND NOT orderComplete
+                RETURNING id
+            """, args=(restaurantID, tableId))
+        return jsonify({"results": [{"orderId": order['id'], "status": "completed"} for order in completed]}), 200
+
+    if not isinstance(orderIds, list) or not orderIds:
+        return jsonify({"message": "Give a list of orderIds or a tableId"}), 400
+    try:
+        orderIds = list(dict.fromkeys(int(orderId) for orderId in orderIds))
+    except (TypeError, ValueError):
+        return jsonify({"message": "Invalid order ID"}), 400
+
+    # One statement updates the open orders and classifies the rest from the same snapshot
+    with transaction():
+        results = query_db("""
+            WITH requested AS (
+                SELECT id, position
+                FROM unnest(%s::INTEGER[]) WITH ORDINALITY AS requested(id, position)
+            ),
+            updated AS (
+                UPDATE orders o
+                SET orderComplete = TRUE
+                FROM requested r
+                WHERE o.id = r.id AND o.restaurantID = %s AND NOT o.orderComplete
+                RETURNING o.id
+            )
+            SELECT
+                r.id AS "orderId",
+                CASE
+                    WHEN u.id IS NOT NULL THEN 'completed'
+                    WHEN o.id IS NOT NULL THEN 'alreadyComplete'
+                    ELSE 'notFound'
+                END AS status
+            FROM requested r
+            LEFT JOIN updated u ON u.id = r.id
+            LEFT JOIN orders o ON o.id = r.id AND o.restaurantID = %s
+            ORDER BY r.position
+        """, args=(orderIds, restaurantID, restaurantID))
+    return jsonify({"results": results}), 200
 
-    if not order_details:
-        return jsonify({"error": "Order not found"}), 404
-    
-    restaurantID = order_details['restaurantid']
-    storedkeys = query_db("""
-        SELECT apikey
-        FROM apikeys
-        WHERE restaurantID = %s
-    """, args=(restaurantID,))
-
-    for storedkey in storedkeys:
-        if storedkey['apikey'] == hashed_key:
-            insert_db("UPDATE orders SET orderComplete = TRUE WHERE id = %s", args=(orderID,))
-            return jsonify({"message": "Order marked as complete"}), 200
-        
-    return jsonify({"message": "Incorrect key given"}), 401
 
 @orders_blueprint.route('/orders/items/<orderId>/', methods=["GET"])
+@use_primary
 @swag_from({
     'tags': ['Orders'],
     'parameters': [{
@@ -338,20 +601,49 @@ def mark_order_complete(orderID):
         }
     }
 })
-def get_order_items(orderID):
-    request_data = query_db("""
+def get_order_items(orderId):
+    request_data = get_order_lines(orderId)
+    if not request_data:
+        request_data = query_db("""
+            SELECT 
+                mi.id, 
+                mi.name, 
+                mi.description, 
+                oim.unitPrice AS price, 
+                oim.quantity
+            FROM OrderIncludesMenuItem_archive oim
+            JOIN MenuItem mi ON oim.menuItemID = mi.id
+            WHERE oim.orderID = %s
+        """, args=(orderId,))
+    return jsonify(request_data)
+
+
+def get_order_lines(orderID):
+    """Returns the order's menu items with the price and quantity they were ordered at."""
+    return query_db("""
         SELECT 
             mi.id, 
             mi.name, 
             mi.description, 
-            mi.price, 
-            COUNT(*) AS quantity
+            oim.unitPrice AS price, 
+            oim.quantity
         FROM OrderIncludesMenuItem oim
         JOIN MenuItem mi ON oim.menuItemID = mi.id
         WHERE oim.orderID = %s
-        GROUP BY mi.id, mi.name, mi.description, mi.price
     """, args=(orderID,))
-    return jsonify(request_data)
+
+
+def mark_order_paid(orderID, email, amount_paid=None):
+    """Marks the order paid and queues its confirmation email in the same transaction.
+    Only the first call for an order does either, so repeated deliveries are harmless.
+    Returns True if this call marked the order paid."""
+    with transaction():
+        paid = query_db("UPDATE orders SET isPaid = TRUE WHERE id = %s AND NOT isPaid RETURNING id",
+                        args=(orderID,), one=True)
+        if paid and email:
+            subject, body = build_order_confirmation(orderID, get_order_lines(orderID), amount_paid)
+            enqueue_email(email, subject, body)
+    return paid is not None
 
 
 @orders_blueprint.route('/orders/<int:orderID>/create-payment-session', methods=['POST'])
@@ -425,32 +717,16 @@ def get_order_items(orderID):
 })
 def create_checkout_session(orderID):
     data = request.get_json()
-    order = query_db("SELECT * FROM orders WHERE id = %s AND isPaid = false", args=(orderID,))
+    order = query_db("SELECT * FROM orders WHERE id = %s AND isPaid = false", args=(orderID,), one=True)
     if not order:
         return jsonify({"error": "Order not found"}), 404
-    
-    result = query_db("""
-        SELECT r.stripekey
-        FROM orders o
-        JOIN restaurant r ON o.restaurantid = r.id
-        WHERE o.id = %s
-    """, args=(orderID,), one=True)
-    
-    stripe.api_key = decrypt(result['stripekey'])
+
+    client = get_stripe_client(order['restaurantid'])
+    if client is None:
+        return jsonify({"error": "Restaurant does not accept payments"}), 404
 
     # Fetch associated menu items and their quantities
-    items = query_db("""
-        SELECT 
-            mi.id, 
-            mi.name, 
-            mi.description, 
-            mi.price, 
-            COUNT(*) AS quantity
-        FROM OrderIncludesMenuItem oim
-        JOIN MenuItem mi ON oim.menuItemID = mi.id
-        WHERE oim.orderID = %s
-        GROUP BY mi.id, mi.name, mi.description, mi.price
-    """, args=(orderID,))
+    items = get_order_lines(orderID)
 
     # Build the line items for Stripe
     line_items = []
@@ -483,41 +759,198 @@ def create_checkout_session(orderID):
 
     try:
         # Create the Stripe Checkout session
-        session = stripe.checkout.Session.create(
-            line_items=line_items,
-            mode='payment',
-            success_url='https://130.225.170.52:10332/payment-success?session_id={CHECKOUT_SESSION_ID}',
-            cancel_url='https://130.225.170.52:10332/payment-success?session_id={CHECKOUT_SESSION_ID}',
-            metadata={
+        session = client.v1.checkout.sessions.create(params={
+            'line_items': line_items,
+            'mode': 'payment',
+            'success_url': 'https://130.225.170.52:10332/payment-success?session_id={CHECKOUT_SESSION_ID}',
+            'cancel_url': 'https://130.225.170.52:10332/payment-success?session_id={CHECKOUT_SESSION_ID}',
+            'metadata': {
                 'orderID': str(orderID),
             }
-        )
+        })
     except Exception as e:
         return str(e)
 
+    # Lets paymentStatus find the order without asking Stripe
+    insert_db("UPDATE orders SET stripeSessionId = %s WHERE id = %s", args=(session.id, orderID))
+
     return jsonify({'checkout_url': session.url})
 
 
+@orders_blueprint.route('/orders/stripeWebhook/<int:restaurantID>', methods=['POST'])
+@swag_from({
+    'tags': ['Orders'],
+    'summary': 'Stripe webhook for a restaurant',
+    'description': 'Register this URL as a webhook endpoint in the restaurant\'s Stripe account, sending checkout.session.completed and checkout.session.async_payment_succeeded, and save its signing secret as the restaurant\'s stripeWebhookSecret. Paid checkout sessions mark their order paid and queue the confirmation email. Repeated deliveries of an event are ignored.',
+    'parameters': [
+        {
+            'name': 'restaurantID',
+            'in': 'path',
+            'required': True,
+            'type': 'integer',
+            'description': 'ID of the restaurant whose Stripe account sends the events.'
+        },
+        {
+            'name': 'Stripe-Signature',
+            'in': 'header',
+            'required': True,
+            'type': 'string',
+            'description': 'Signature Stripe computes with the webhook signing secret.'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Event received'
+        },
+        400: {
+            'description': 'Invalid payload or signature'
+        },
+        404: {
+            'description': 'The restaurant has no Stripe webhook secret configured'
+        }
+    }
+})
+def stripe_webhook(restaurantID):
+    restaurant = query_db("SELECT stripeWebhookSecret FROM restaurant WHERE id = %s",
+                          args=(restaurantID,), one=True)
+    if not restaurant or not restaurant['stripewebhooksecret']:
+        return jsonify({"error": "No Stripe webhook configured for this restaurant"}), 404
+
+    payload = request.get_data()
+    try:
+        stripe.Webhook.construct_event(payload, request.headers.get("Stripe-Signature", ""),
+                                       decrypt(restaurant['stripewebhooksecret']))
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return jsonify({"error": "Invalid payload or signature"}), 400
+
+    event = json.loads(payload)
+    if event['type'] in ("checkout.session.completed", "checkout.session.async_payment_succeeded"):
+        session = event['data']['object']
+        orderID = (session.get('metadata') or {}).get('orderID')
+        if session.get('payment_status') == "paid" and orderID:
+            order = query_db("SELECT id FROM orders WHERE id = %s AND restaurantID = %s",
+                             args=(orderID, restaurantID), one=True)
+            if order:
+                email = (session.get('customer_details') or {}).get('email')
+                amount_paid = session['amount_total'] / 100 if session.get('amount_total') is not None else None
+                mark_order_paid(order['id'], email, amount_paid)
+
+    return jsonify({"received": True}), 200
+
+
+def wait_for_payment(order, timeout):
+    """Waits up to `timeout` seconds for the order to be marked paid. Returns True once it is,
+    or None if the order is gone meanwhile (archived or deleted)."""
+    events = order_feed.subscribe(order['restaurantid'])
+    try:
+        # Checked after subscribing, which returns once the LISTEN is in place, so a
+        # payment landing in between is not missed
+        current = query_db("SELECT isPaid FROM orders WHERE id = %s", args=(order['id'],), one=True)
+        if not current:
+            return None
+        if current['ispaid']:
+            return True
+        # Nothing else needs the database while waiting
+        release_connections()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                event = events.get(timeout=remaining)
+            except queue.Empty:
+                return False
+            if event['event'] == "paid" and event['orderId'] == order['id']:
+                return True
+    finally:
+        order_feed.unsubscribe(order['restaurantid'], events)
+
+
+def missing_order_status(sessionID):
+    """The paymentStatus answer for a checkout session whose order is not in orders."""
+    # Only paid orders are archived
+    if query_db("SELECT 1 FROM orders_archive WHERE stripeSessionId = %s", args=(sessionID,), one=True):
+        return jsonify({'status': "paid"}), 200
+    return jsonify({'message': 'Checkout session not found'}), 404
+
+
 @orders_blueprint.route('/orders/paymentStatus', methods=['PUT'])
+@use_primary
+@swag_from({
+    'tags': ['Orders'],
+    'summary': 'Get the payment status of a checkout session',
+    'description': 'Looks the order up by its checkout session. For restaurants with a Stripe webhook the status is answered locally, and the call can wait up to `wait` seconds for the payment to arrive. Other restaurants fall back to asking Stripe.',
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'sessionID': {
+                        'type': 'string',
+                        'description': 'ID of the Stripe checkout session.'
+                    },
+                    'wait': {
+                        'type': 'number',
+                        'description': f'Seconds to wait for the payment before answering unpaid (default 0, at most {PAYMENT_STATUS_MAX_WAIT}).'
+                    }
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'The status, "paid" or "unpaid"'
+        },
+        400: {
+            'description': 'Missing sessionID'
+        },
+        404: {
+            'description': 'No order has this checkout session'
+        }
+    }
+})
 def update_payment_status():
     data = request.get_json()
     sessionID = data.get('sessionID')
     if not sessionID:
         return jsonify({'message': 'Missing sessionID'}), 400
     try:
-        session = stripe.checkout.Session.retrieve(sessionID)
-        orderID = session.metadata.get('orderID')
-        payment_status = session.payment_status
+        wait = min(max(float(data.get('wait', 0)), 0), PAYMENT_STATUS_MAX_WAIT)
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid wait'}), 400
 
-        order = query_db("SELECT * FROM orders WHERE id = %s AND isPaid = true", args=(orderID,), one=True)
-        if order:
+    order = query_db("""
+        SELECT o.id, o.restaurantID, o.isPaid, r.stripeWebhookSecret IS NOT NULL AS hasWebhook
+        FROM orders o
+        JOIN restaurant r ON o.restaurantID = r.id
+        WHERE o.stripeSessionId = %s
+    """, args=(sessionID,), one=True)
+    if not order:
+        return missing_order_status(sessionID)
+    if order['ispaid']:
+        return jsonify({'status': "paid"}), 200
+
+    # The webhook marks these orders paid, so there is nothing to ask Stripe
+    if order['haswebhook']:
+        paid = wait_for_payment(order, wait) if wait else False
+        if paid is None:
+            return missing_order_status(sessionID)
+        if paid:
             return jsonify({'status': "paid"}), 200
+        return jsonify({'status': "unpaid"}), 200
+
+    try:
+        client = get_stripe_client(order['restaurantid'])
+        session = client.v1.checkout.sessions.retrieve(sessionID)
+        payment_status = session.payment_status
 
         if payment_status == "paid":
-            insert_db("UPDATE orders SET isPaid = TRUE WHERE id = %s", args=(orderID,))
-            line_items = stripe.checkout.Session.list_line_items(sessionID)
-            email = session.customer_details.email
-            send_order_confirmation(email,orderID,line_items)
+            email = session.customer_details.email if session.customer_details else None
+            mark_order_paid(order['id'], email, session.amount_total / 100)
             return jsonify({'status': payment_status}), 200
         else: 
             return jsonify({'status': "unpaid"}), 200
@@ -1,6 +1,7 @@
 from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from database import insert_db, iter_query_db
 from flasgger import swag_from
+from extensions import stream_json
 
 ratings_blueprint = Blueprint('ratings', __name__)
 
@@ -43,8 +44,8 @@ ratings_blueprint = Blueprint('ratings', __name__)
 })
 def get_ratings():
     try:
-        ratings = query_db('SELECT * FROM rating')
-        return jsonify(ratings), 200
+        ratings = iter_query_db('SELECT * FROM rating')
+        return stream_json(ratings), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
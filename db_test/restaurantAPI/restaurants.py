@@ -1,10 +1,22 @@
-from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from flask import Blueprint, jsonify, request, url_for
+from database import query_db, insert_db, iter_query_db, transaction
 from flasgger import swag_from
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, JWTManager
-from extensions import encrypt
+from extensions import encrypt, stream_json
+from stripe_clients import invalidate as invalidate_stripe_client
+from api_key_auth import invalidate as invalidate_api_key
+from spatial_index import get_spatial_index
+from opening_hours import OPEN_FILTER_PARAMETERS, requested_minute
 import stripe
-import math
+import os
+
+# Page size of GET /restaurants when after_id is given without a limit, and the largest allowed limit
+RESTAURANTS_PAGE_SIZE = int(os.environ.get("RESTAURANTS_PAGE_SIZE", 100))
+RESTAURANTS_MAX_PAGE_SIZE = int(os.environ.get("RESTAURANTS_MAX_PAGE_SIZE", 1000))
+
+# Columns GET /restaurants may return, as named in the response
+RESTAURANT_FIELDS = ("id", "ownerid", "name", "latitude", "longitude", "theme", "openingtime",
+                     "closingtime", "description", "averagerating", "totaltables")
 
 
 restaurants_blueprint = Blueprint('restaurants', __name__)
@@ -61,12 +73,19 @@ def get_restaurant(restaurantID):
     )
     return jsonify(request_data)
 
+
 @restaurants_blueprint.route('/restaurants', methods=["GET"])
 @swag_from({
     'tags': ['Restaurants'],
     'responses': {
         200: {
-            'description': 'A list of all restaurants',
+            'description': 'A list of all restaurants, or one page of them with after_id or limit',
+            'headers': {
+                'Link': {
+                    'type': 'string',
+                    'description': 'URL of the next page with rel="next", when the page is full'
+                }
+            },
             'schema': {
                 'type': 'array',
                 'items': {
@@ -92,21 +111,87 @@ def get_restaurant(restaurantID):
                 }
             }
         },
+        400: {
+            'description': 'Invalid after_id, limit, fields or open_at'
+        },
         500: {
             'description': 'Internal Server Error'
         }
-    }
+    },
+    'parameters': [{
+        'name': 'after_id',
+        'description': 'Return restaurants with an ID above this, ordered by ID. Pass the last ID of the previous page, '
+                       'or follow the Link header with rel="next".',
+        'in': 'query',
+        'type': 'integer',
+        'required': False
+    }, {
+        'name': 'limit',
+        'description': f'Page size, at most {RESTAURANTS_MAX_PAGE_SIZE}. Without after_id or limit every restaurant is returned.',
+        'in': 'query',
+        'type': 'integer',
+        'required': False
+    }, {
+        'name': 'fields',
+        'description': 'Comma-separated columns to return, e.g. id,name,latitude,longitude,averagerating. '
+                       f'One of: {", ".join(RESTAURANT_FIELDS)}. id is always included.',
+        'in': 'query',
+        'type': 'string',
+        'required': False
+    }] + OPEN_FILTER_PARAMETERS
 })
 def get_all_restaurants():
     try:
-        restaurants = query_db(
-            """
-            SELECT id, ownerID, name, latitude, longitude, theme, openingtime,
-                closingtime, description, averageRating, totaltables
-            FROM restaurant
-            """
-        )        
-        return jsonify(restaurants), 200
+        open_minute = requested_minute(request.args)
+    except ValueError:
+        return jsonify({"error": "open_at must be an ISO 8601 time"}), 400
+
+    fields = RESTAURANT_FIELDS
+    if request.args.get("fields"):
+        requested = [field.strip().lower() for field in request.args["fields"].split(",") if field.strip()]
+        unknown = [field for field in requested if field not in RESTAURANT_FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+        # id is kept so clients can page on it
+        fields = ["id"] + [field for field in dict.fromkeys(requested) if field != "id"]
+
+    paged = "after_id" in request.args or "limit" in request.args
+    try:
+        after_id = int(request.args.get("after_id", 0))
+        limit = int(request.args.get("limit", RESTAURANTS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "after_id and limit must be integers"}), 400
+    if not 1 <= limit <= RESTAURANTS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {RESTAURANTS_MAX_PAGE_SIZE}"}), 400
+
+    # The field names come from RESTAURANT_FIELDS, never from the request
+    query = f"SELECT {', '.join(fields)} FROM restaurant"
+    conditions = []
+    args = []
+    if open_minute is not None:
+        conditions.append("""EXISTS (
+            SELECT 1 FROM restaurantOpeningHours h
+            WHERE h.restaurantID = restaurant.id AND h.minutes @> %s::INTEGER
+        )""")
+        args.append(open_minute)
+    if paged:
+        conditions.append("id > %s")
+        args.append(after_id)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    try:
+        if not paged:
+            return stream_json(iter_query_db(query, args=tuple(args))), 200
+
+        # Keyset pagination walks the primary key, so every page costs the same
+        restaurants = query_db(query + " ORDER BY id LIMIT %s", args=tuple(args) + (limit,))
+        headers = {}
+        if len(restaurants) == limit:
+            next_args = request.args.to_dict()
+            next_args.update(after_id=restaurants[-1]['id'], limit=limit)
+            headers["Link"] = f'<{url_for(request.endpoint, **next_args)}>; rel="next"'
+        return jsonify(restaurants), 200, headers
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -195,9 +280,8 @@ def add_restaurant():
     if not name or not latitude or not longitude or not stripeKey or not totaltables:
         return jsonify({"error": "Missing required fields"}), 400
 
-    stripe.api_key = stripeKey
     try:
-        stripe.Account.retrieve()
+        stripe.StripeClient(stripeKey).v1.accounts.retrieve_current()
     except stripe.error.AuthenticationError:
         return jsonify({"message": "Invalid stripe key"}), 401
     except Exception as e:
@@ -205,8 +289,9 @@ def add_restaurant():
 
     stripeKey = encrypt(stripeKey)
 
-    insert_db('INSERT INTO restaurant (name, latitude, longitude, ownerID, stripekey, openingtime, closingtime, description, totaltables) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-              args=(name, latitude, longitude, ownerID, stripeKey, openingtime, closingtime, description, totaltables))
+    restaurantID = insert_db('INSERT INTO restaurant (name, latitude, longitude, ownerID, stripekey, openingtime, closingtime, description, totaltables) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id',
+                             args=(name, latitude, longitude, ownerID, stripeKey, openingtime, closingtime, description, totaltables))
+    get_spatial_index().refresh(restaurantID)
     return jsonify({"message": "Restaurant added successfully"}), 200
 
 
@@ -267,6 +352,10 @@ def add_restaurant():
                     'stripeKey': {
                         'type': 'string',
                         'description': 'The Stripe payment key for the restaurant (optional)',
+                    },
+                    'stripeWebhookSecret': {
+                        'type': 'string',
+                        'description': 'Signing secret of the Stripe webhook pointing at /orders/stripeWebhook/{restaurant_id} (optional)',
                     },
                         'totaltables': {
                         'type': 'int',
@@ -299,28 +388,34 @@ def update_restaurant(restaurant_id):
     description = data.get("description")
     stripeKey = data.get("stripeKey")
     totaltables = data.get("totaltables")
+    stripeWebhookSecret = data.get("stripeWebhookSecret")
 
 
     if not name or not latitude or not longitude or not totaltables:
         return jsonify({"error": "Missing required fields"}), 400
-    
-    if not stripeKey:
-            insert_db("UPDATE restaurant SET name = %s, latitude = %s, longitude = %s, openingtime = %s, closingtime = %s, description = %s, totaltables = %s WHERE id = %s", 
-              args=(name, latitude, longitude, openingtime, closingtime, description, totaltables, restaurant_id))
-            return jsonify({"message": "Restaurant updated successfully"}), 200
-    
-    stripe.api_key = stripeKey
-    try:
-        stripe.Account.retrieve()
-    except stripe.error.AuthenticationError:
-        return jsonify({"message": "Invalid stripe key"}), 401
-    except Exception as e:
-        return jsonify({"error": f"An error occurred: {e}"}), 500
-    
-    stripeKey = encrypt(stripeKey)
 
-    insert_db("UPDATE restaurant SET name = %s, latitude = %s, longitude = %s, openingtime = %s, closingtime = %s, description = %s, stripekey = %s, totaltables = %s WHERE id = %s", 
-              args=(name, latitude, longitude, openingtime, closingtime, description, stripeKey, totaltables, restaurant_id))
+    if stripeKey:
+        try:
+            stripe.StripeClient(stripeKey).v1.accounts.retrieve_current()
+        except stripe.error.AuthenticationError:
+            return jsonify({"message": "Invalid stripe key"}), 401
+        except Exception as e:
+            return jsonify({"error": f"An error occurred: {e}"}), 500
+
+    # Nothing is written until the key checked out, and then everything at once.
+    # A key or webhook secret that is not given is left as it is.
+    with transaction():
+        insert_db("""
+            UPDATE restaurant SET name = %s, latitude = %s, longitude = %s, openingtime = %s, closingtime = %s,
+                description = %s, totaltables = %s, stripekey = COALESCE(%s, stripekey),
+                stripeWebhookSecret = COALESCE(%s, stripeWebhookSecret)
+            WHERE id = %s
+        """, args=(name, latitude, longitude, openingtime, closingtime, description, totaltables,
+                   encrypt(stripeKey) if stripeKey else None,
+                   encrypt(stripeWebhookSecret) if stripeWebhookSecret else None, restaurant_id))
+        if stripeKey:
+            invalidate_stripe_client(restaurant_id)
+    get_spatial_index().refresh(restaurant_id)
     return jsonify({"message": "Restaurant updated successfully"}), 200
 
 
@@ -344,7 +439,13 @@ def update_restaurant(restaurant_id):
 })
 def delete_restaurant(restaurantID):
     try:
-        insert_db('DELETE FROM restaurant WHERE id = %s', args=(restaurantID,))
+        with transaction():
+            # The restaurant's API keys would go with it by cascade, unnoticed by the workers' key caches
+            keys = query_db("DELETE FROM apikeys WHERE restaurantID = %s RETURNING apikey", args=(restaurantID,))
+            for key in keys:
+                invalidate_api_key(key['apikey'])
+            insert_db('DELETE FROM restaurant WHERE id = %s', args=(restaurantID,))
+        get_spatial_index().refresh(restaurantID)
         return jsonify({"message": "Restaurant deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -383,7 +484,7 @@ def delete_restaurant(restaurantID):
             }
         },
         400: {
-            'description': 'Latitude and longitude are required'
+            'description': 'Latitude and longitude are required, or open_at is not an ISO 8601 time'
         }},
     'parameters': [{
         'name': 'lat',
@@ -403,65 +504,28 @@ def delete_restaurant(restaurantID):
         'in': 'query',
         'type': 'number',
         'required': False
-    }]
+    }, {
+        'name': 'rating_weight',
+        'description': 'Rank by distance in km minus this many km per star of averageRating, instead of by distance alone',
+        'in': 'query',
+        'type': 'number',
+        'required': False
+    }] + OPEN_FILTER_PARAMETERS
 })
 def get_closest_10_restaurants():
     lat = float(request.args.get('lat'))
     lon = float(request.args.get('lon'))
     radius_km = float(request.args.get('radius_km', 10))
-    min_lat, max_lat, min_lon, max_lon = get_bounding_box(lat, lon, radius_km)
-
-    restaurants = query_db("""SELECT id, ownerID, name, latitude, longitude, theme, openingtime, 
-                           closingtime, description, averageRating, totaltables 
-                           FROM restaurant 
-                           WHERE latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s""",
-                           args=(min_lat, max_lat, min_lon, max_lon))
-    restaurants = sorted(restaurants, key=lambda x: haversine(lat, lon, x['latitude'], x['longitude']))
-    return jsonify(restaurants[:10])
-
-
-
-def get_bounding_box(lat, lon, radius_km):
-    # Approximate radius of Earth in km
-    R = 6371.0
-
-    # Convert latitude and longitude from degrees to radians
-    lat_rad = math.radians(lat)
-
-    # Latitude bounds (1 deg ~ 111 km)
-    delta_lat = radius_km / 111.0
-
-    # Longitude bounds (1 deg ~ varies with latitude)
-    delta_lon = radius_km / (111.320 * math.cos(lat_rad))
-
-    min_lat = lat - delta_lat
-    max_lat = lat + delta_lat
-    min_lon = lon - delta_lon
-    max_lon = lon + delta_lon
-
-    return min_lat, max_lat, min_lon, max_lon
-
-
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    taken from the following source: https://www.geeksforgeeks.org/haversine-formula-to-find-distance-between-two-points-on-a-sphere/
-    """
-    # distance between latitudes
-    # and longitudes
-    dLat = (lat2 - lat1) * math.pi / 180.0
-    dLon = (lon2 - lon1) * math.pi / 180.0
- 
-    # convert to radians
-    lat1 = (lat1) * math.pi / 180.0
-    lat2 = (lat2) * math.pi / 180.0
- 
-    # apply formulae
-    a = (pow(math.sin(dLat / 2), 2) +
-         pow(math.sin(dLon / 2), 2) *
-         math.cos(lat1) * math.cos(lat2))
-    rad = 6371
-    c = 2 * math.asin(math.sqrt(a))
-    return rad * c
+    rating_weight = float(request.args.get('rating_weight', 0))
+    try:
+        open_minute = requested_minute(request.args)
+    except ValueError:
+        return jsonify({"error": "open_at must be an ISO 8601 time"}), 400
+
+    # Answered from this worker's in-memory index, without a database round trip
+    return jsonify(get_spatial_index().nearest(lat, lon, radius_km, 10, rating_weight=rating_weight,
+                                               open_minute=open_minute))
+
 
 @restaurants_blueprint.route('/restaurants/theme/<themename>', methods=["GET"])
 @swag_from({
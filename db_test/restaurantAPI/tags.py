@@ -1,7 +1,8 @@
 from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from database import insert_db, iter_query_db
 from flasgger import swag_from
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from extensions import stream_json
 import os
 
 tags_blueprint = Blueprint('tags', __name__)
@@ -31,10 +32,10 @@ tags_blueprint = Blueprint('tags', __name__)
     }
 })
 def get_all_tags():
-    tags = query_db("""
+    tags = iter_query_db("""
                     SELECT * FROM tag 
                     """)
-    return jsonify(tags)
+    return stream_json(tags)
 
 
 @tags_blueprint.route("/tags/create/", methods=["POST"])
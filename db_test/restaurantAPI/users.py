@@ -1,6 +1,7 @@
 from flask import Blueprint, jsonify, request
-from database import query_db, insert_db
+from database import insert_db, iter_query_db
 from flasgger import swag_from
+from extensions import stream_json
 
 users_blueprint = Blueprint('users', __name__)
 
@@ -35,8 +36,8 @@ users_blueprint = Blueprint('users', __name__)
     }
 })
 def get_users():
-    users = query_db("SELECT * FROM users")
-    return jsonify(users)
+    users = iter_query_db("SELECT * FROM users")
+    return stream_json(users)
 
 
 @users_blueprint.route('/users/adduser', methods=["POST"])
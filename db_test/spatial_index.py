@@ -0,0 +1,333 @@
+from database import checkout, get_pool
+from notifications import get_listener
+from psycopg2 import extras
+import math
+import numpy as np
+import os
+import threading
+import time
+
+# Size in degrees of the grid cells restaurants are bucketed into (0.02 is about 2 km north-south)
+SPATIAL_INDEX_CELL_DEGREES = float(os.environ.get("SPATIAL_INDEX_CELL_DEGREES", 0.02))
+# Seconds between full reloads, which catch changes announced while the listener was reconnecting
+SPATIAL_INDEX_RELOAD_INTERVAL = int(os.environ.get("SPATIAL_INDEX_RELOAD_INTERVAL", 300))
+
+RESTAURANT_COLUMNS = """
+    id, ownerID, name, latitude, longitude, theme, openingtime,
+    closingtime, description, averageRating, totaltables
+"""
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    taken from the following source: https://www.geeksforgeeks.org/haversine-formula-to-find-distance-between-two-points-on-a-sphere/
+    """
+    # distance between latitudes
+    # and longitudes
+    dLat = (lat2 - lat1) * math.pi / 180.0
+    dLon = (lon2 - lon1) * math.pi / 180.0
+
+    # convert to radians
+    lat1 = (lat1) * math.pi / 180.0
+    lat2 = (lat2) * math.pi / 180.0
+
+    # apply formulae
+    a = (pow(math.sin(dLat / 2), 2) +
+         pow(math.sin(dLon / 2), 2) *
+         math.cos(lat1) * math.cos(lat2))
+    rad = 6371
+    c = 2 * math.asin(math.sqrt(a))
+    return rad * c
+
+
+EARTH_RADIUS_KM = 6371
+# Ratings are 1-5 stars, so no averageRating is above this
+MAX_RATING = 5
+
+
+def get_bounding_box(lat, lon, radius_km):
+    # Latitude bounds (1 deg ~ 111 km)
+    delta_lat = radius_km / 111.0
+
+    # Longitude bounds (1 deg ~ varies with latitude)
+    delta_lon = radius_km / (111.320 * math.cos(math.radians(lat)))
+
+    return lat - delta_lat, lat + delta_lat, lon - delta_lon, lon + delta_lon
+
+
+def haversine_many(lat, lon, lats, lons):
+    """haversine() from one point to arrays of coordinates, in one NumPy pass."""
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.sin(np.radians(lons - lon) / 2) ** 2 * np.cos(lat1) * np.cos(lat2))
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def top_k(scores, k):
+    """Indexes of the `k` smallest scores, smallest first. Only those k are sorted."""
+    if len(scores) > k:
+        candidates = np.argpartition(scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(scores[candidates], kind="stable")]
+
+
+def _fetch_restaurants(where="", args=()):
+    # Runs outside of requests too (on the listener thread), so it borrows a pooled
+    # connection directly instead of going through query_db. A full load reads every
+    # restaurant, so it gets the admin statement timeout.
+    pool = get_pool()
+    con = checkout(pool, "admin")
+    broken = False
+    try:
+        with con.cursor(cursor_factory=extras.RealDictCursor) as cur:
+            cur.execute(f"""
+                SELECT {RESTAURANT_COLUMNS},
+                    ARRAY(SELECT ARRAY[lower(h.minutes), upper(h.minutes)]
+                          FROM restaurantOpeningHours h
+                          WHERE h.restaurantID = restaurant.id) AS openingminutes
+                FROM restaurant {where}
+                """, args)
+            rows = cur.fetchall()
+        con.commit()
+        return rows
+    except BaseException:
+        broken = con.closed != 0
+        if not broken:
+            con.rollback()
+        raise
+    finally:
+        pool.putconn(con, broken=broken)
+
+
+class SpatialIndex:
+    """Per-worker grid of restaurants by coordinates, answering nearest-restaurant
+    queries from memory.
+
+    Restaurants are bucketed into square cells of `cell_degrees`, and each cell keeps
+    its coordinates, ratings and opening hours as arrays so candidates are scored in
+    bulk. A search gathers rings of cells outward from the query point until no cell
+    further out can beat the results it has. Every worker keeps its copy current through the
+    restaurant_changes NOTIFY channel.
+    """
+
+    def __init__(self, cell_degrees, reload_interval):
+        self.cell_degrees = cell_degrees
+        self.reload_interval = reload_interval
+        self.pid = os.getpid()
+        self._cells = {}
+        self._cell_of = {}
+        self._opening_minutes = {}
+        self._arrays = {}
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._loaded_at = None
+        self._listening = False
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    def _put(self, row):
+        self._remove(row['id'])
+        # Kept apart from the row, which is returned to clients as it is
+        opening_minutes = row.pop('openingminutes', None) or []
+        if row['latitude'] is None or row['longitude'] is None:
+            return
+        self._opening_minutes[row['id']] = opening_minutes
+        cell = self._cell(row['latitude'], row['longitude'])
+        self._cells.setdefault(cell, {})[row['id']] = row
+        self._cell_of[row['id']] = cell
+        self._arrays.pop(cell, None)
+
+    def _remove(self, restaurantID):
+        self._opening_minutes.pop(restaurantID, None)
+        cell = self._cell_of.pop(restaurantID, None)
+        if cell is not None:
+            self._arrays.pop(cell, None)
+            bucket = self._cells[cell]
+            del bucket[restaurantID]
+            if not bucket:
+                del self._cells[cell]
+
+    def load(self):
+        """Replaces the index with every restaurant in the database."""
+        # Changes are applied as they are announced from here on; any the listener misses
+        # are picked up by the next reload
+        if not self._listening:
+            get_listener().subscribe("restaurant_changes", self._on_notify)
+            self._listening = True
+        loaded_at = time.monotonic()
+        self.replace(_fetch_restaurants(), loaded_at)
+
+    def replace(self, rows, loaded_at=None):
+        """Replaces the index contents with `rows`, current as of `loaded_at` (default now)."""
+        with self._lock:
+            self._cells = {}
+            self._cell_of = {}
+            self._opening_minutes = {}
+            self._arrays = {}
+            for row in rows:
+                self._put(dict(row))
+            for cell in self._cells:
+                self._cell_arrays(cell)
+            self._loaded_at = time.monotonic() if loaded_at is None else loaded_at
+
+    def refresh(self, restaurantID):
+        """Re-reads one restaurant, adding, moving or dropping it as needed."""
+        restaurantID = int(restaurantID)
+        rows = _fetch_restaurants("WHERE id = %s", (restaurantID,))
+        with self._lock:
+            if rows:
+                self._put(dict(rows[0]))
+            else:
+                self._remove(restaurantID)
+
+    def _on_notify(self, payload):
+        if self._loaded_at is not None:
+            self.refresh(payload)
+
+    def _ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.reload_interval:
+            return
+        # One thread reloads while the others keep answering from the current copy
+        if self._reload_lock.acquire(blocking=loaded_at is None):
+            try:
+                if self._loaded_at is loaded_at:
+                    self.load()
+            finally:
+                self._reload_lock.release()
+
+    def _cell_arrays(self, cell):
+        """The cell's rows, their latitudes, longitudes and ratings as an (n, 3) array and
+        their opening minute ranges as an (n, ranges, 2) array. Built again after the cell
+        changes."""
+        arrays = self._arrays.get(cell)
+        if arrays is None:
+            rows = list(self._cells[cell].values())
+            opening_minutes = [self._opening_minutes[row['id']] for row in rows]
+            # Padded with empty ranges, which contain no minute
+            hours = np.zeros((len(rows), max(map(len, opening_minutes), default=0) or 1, 2), dtype=np.int32)
+            for i, ranges in enumerate(opening_minutes):
+                if ranges:
+                    hours[i, :len(ranges)] = ranges
+            arrays = self._arrays[cell] = (
+                rows,
+                np.array([[row['latitude'], row['longitude'], row['averagerating'] or 0] for row in rows],
+                         dtype=np.float64).reshape(-1, 3),
+                hours)
+        return arrays
+
+    def _ring_distance(self, lat, lon, ci, cj, ring):
+        """Lower bound in km on the distance from the point to anything `ring` or more
+        cells away from its own cell (ci, cj)."""
+        lat_lo = (ci - ring + 1) * self.cell_degrees
+        lat_hi = (ci + ring) * self.cell_degrees
+        lon_lo = (cj - ring + 1) * self.cell_degrees
+        lon_hi = (cj + ring) * self.cell_degrees
+        to_parallel = math.radians(min(lat - lat_lo, lat_hi - lat))
+        # Distance to a meridian `d` degrees of longitude away
+        d = math.radians(min(lon - lon_lo, lon_hi - lon, 90))
+        to_meridian = math.asin(min(1.0, math.cos(math.radians(lat)) * math.sin(d)))
+        return EARTH_RADIUS_KM * min(to_parallel, to_meridian)
+
+    def _ring_cells(self, ci, cj, ring, min_i, max_i, min_j, max_j):
+        """The cells exactly `ring` cells away from (ci, cj), clipped to the search box."""
+        for i in range(max(ci - ring, min_i), min(ci + ring, max_i) + 1):
+            if abs(i - ci) == ring:
+                columns = range(max(cj - ring, min_j), min(cj + ring, max_j) + 1)
+            else:
+                # Only the ring's edge, the inside was gathered already
+                columns = [j for j in (cj - ring, cj + ring) if min_j <= j <= max_j]
+            for j in columns:
+                if (i, j) in self._cells:
+                    yield i, j
+
+    def nearest(self, lat, lon, radius_km, limit, rating_weight=0.0, open_minute=None):
+        """Returns up to `limit` restaurants within `radius_km` of the point, nearest first.
+
+        With a `rating_weight` they are ranked by distance in km minus `rating_weight`
+        times their averageRating instead, so better rated restaurants rank as if closer.
+        With an `open_minute` only restaurants open at that minute of the week are returned.
+        """
+        min_lat, max_lat, min_lon, max_lon = get_bounding_box(lat, lon, radius_km)
+        self._ensure_loaded()
+        ci, cj = self._cell(lat, lon)
+        min_i, min_j = self._cell(min_lat, min_lon)
+        max_i, max_j = self._cell(max_lat, max_lon)
+        # No restaurant scores below its distance minus this
+        rating_bonus = max(rating_weight, 0) * MAX_RATING
+
+        with self._lock:
+            last_ring = max(ci - min_i, max_i - ci, cj - min_j, max_j - cj)
+            if (max_i - min_i + 1) * (max_j - min_j + 1) > 4 * len(self._cells):
+                # Wide searches would walk mostly empty cells, so sort the occupied ones into rings
+                rings = {}
+                for cell in self._cells:
+                    if min_i <= cell[0] <= max_i and min_j <= cell[1] <= max_j:
+                        rings.setdefault(max(abs(cell[0] - ci), abs(cell[1] - cj)), []).append(cell)
+                ring_cells = lambda ring: rings.get(ring, ())
+            else:
+                ring_cells = lambda ring: self._ring_cells(ci, cj, ring, min_i, max_i, min_j, max_j)
+
+            # Gather rings until they hold enough restaurants to bound the answer
+            cells = []
+            found = 0
+            ring = 0
+            while ring <= last_ring and found < limit:
+                for cell in ring_cells(ring):
+                    cells.append(cell)
+                    found += len(self._cells[cell])
+                ring += 1
+
+            rows, inside, scores = self._score(cells, lat, lon, rating_weight, open_minute, min_lat, max_lat, min_lon, max_lon)
+            # Take in the rings that could still hold something scoring better than the
+            # current limit-th best, or the rest of the box if there is no limit-th yet
+            worst = np.partition(scores, limit - 1)[limit - 1] if len(scores) >= limit else np.inf
+            gathered = len(cells)
+            while ring <= last_ring and self._ring_distance(lat, lon, ci, cj, ring) - rating_bonus < worst:
+                cells.extend(ring_cells(ring))
+                ring += 1
+            if len(cells) > gathered:
+                rows, inside, scores = self._score(cells, lat, lon, rating_weight, open_minute, min_lat, max_lat, min_lon, max_lon)
+        return [rows[inside[i]] for i in top_k(scores, limit)]
+
+    def _score(self, cells, lat, lon, rating_weight, open_minute, min_lat, max_lat, min_lon, max_lon):
+        """The rows of `cells`, the positions of those inside the bounding box (and open
+        at `open_minute`) and their ranking scores."""
+        if not cells:
+            return [], np.empty(0, dtype=np.intp), np.empty(0)
+        rows = []
+        coordinates = []
+        open_now = []
+        for cell in cells:
+            cell_rows, cell_coordinates, cell_hours = self._cell_arrays(cell)
+            rows.extend(cell_rows)
+            coordinates.append(cell_coordinates)
+            if open_minute is not None:
+                open_now.append(((cell_hours[:, :, 0] <= open_minute) & (open_minute < cell_hours[:, :, 1])).any(axis=1))
+        coordinates = np.concatenate(coordinates)
+        lats, lons, ratings = coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]
+        wanted = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+        if open_minute is not None:
+            wanted &= np.concatenate(open_now)
+        inside = np.flatnonzero(wanted)
+        scores = haversine_many(lat, lon, lats[inside], lons[inside])
+        if rating_weight:
+            scores -= rating_weight * ratings[inside]
+        return rows, inside, scores
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_spatial_index():
+    """Returns this process' spatial index, creating it after a fork. It loads on first use."""
+    global _index
+    if _index is None or _index.pid != os.getpid():
+        with _index_lock:
+            if _index is None or _index.pid != os.getpid():
+                _index = SpatialIndex(SPATIAL_INDEX_CELL_DEGREES, SPATIAL_INDEX_RELOAD_INTERVAL)
+    return _index
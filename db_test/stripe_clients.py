@@ -0,0 +1,114 @@
+from database import query_db, insert_db
+from extensions import decrypt
+from notifications import get_listener
+from collections import OrderedDict
+import os
+import requests
+import stripe
+import threading
+import time
+
+# Restaurants whose Stripe client is kept per worker, least recently used evicted first
+STRIPE_CLIENT_CACHE_SIZE = int(os.environ.get("STRIPE_CLIENT_CACHE_SIZE", 256))
+# Seconds a decrypted key is reused before it is read from the database again
+STRIPE_CLIENT_TTL = int(os.environ.get("STRIPE_CLIENT_TTL", 600))
+
+
+class StripeClientRegistry:
+    """Per-restaurant Stripe clients with their decrypted keys, cached for a bounded time.
+
+    Each client keeps its own keep-alive HTTP session to Stripe, and nothing touches
+    the process-global stripe.api_key, so concurrent requests for different
+    restaurants cannot use each other's key. Clients are only reused while the
+    stripe_keys channel, which announces rotated keys, is listened to.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.pid = os.getpid()
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed = False
+        # The listener connection the clients were cached under
+        self._connection = None
+
+    def get(self, restaurantID):
+        """Returns the restaurant's StripeClient, or None if it has no Stripe key."""
+        restaurantID = int(restaurantID)
+        listening = self._listen()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.get(restaurantID) if listening else None
+            if entry is not None and entry[1] > now:
+                self._clients.move_to_end(restaurantID)
+                return entry[0]
+
+        restaurant = query_db("SELECT stripekey FROM restaurant WHERE id = %s", args=(restaurantID,), one=True)
+        if not restaurant or not restaurant['stripekey']:
+            return None
+        # An explicit session: RequestsClient otherwise keeps one per thread, which under
+        # gevent means per greenlet, so connections would not be reused across requests
+        http_client = stripe.RequestsClient(session=requests.Session())
+        client = stripe.StripeClient(decrypt(restaurant['stripekey']), http_client=http_client)
+        if not listening:
+            return client
+
+        with self._lock:
+            self._clients[restaurantID] = (client, now + self.ttl)
+            self._clients.move_to_end(restaurantID)
+            while len(self._clients) > self.maxsize:
+                self._clients.popitem(last=False)
+        return client
+
+    def discard(self, restaurantID):
+        """Drops this worker's cached client for the restaurant."""
+        with self._lock:
+            self._clients.pop(int(restaurantID), None)
+
+    def _on_notify(self, payload):
+        self.discard(payload)
+
+    def _listen(self):
+        """Subscribes to stripe_keys, on which other workers announce rotated keys, on first
+        use. Returns whether those announcements reach this worker right now. Clients are
+        dropped when the listener reconnected, as it may have missed some in between."""
+        listener = get_listener()
+        if not self._subscribed:
+            with self._lock:
+                subscribe = not self._subscribed
+                self._subscribed = True
+            # Outside the lock, as it waits for the LISTEN to be issued
+            if subscribe:
+                listener.subscribe("stripe_keys", self._on_notify)
+        connection = listener.listening("stripe_keys")
+        if connection != self._connection:
+            with self._lock:
+                self._clients.clear()
+                self._connection = connection
+        return connection is not None
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def _get_registry():
+    global _registry
+    if _registry is None or _registry.pid != os.getpid():
+        with _registry_lock:
+            if _registry is None or _registry.pid != os.getpid():
+                _registry = StripeClientRegistry(STRIPE_CLIENT_CACHE_SIZE, STRIPE_CLIENT_TTL)
+    return _registry
+
+
+def get_stripe_client(restaurantID):
+    """Returns the restaurant's StripeClient, or None if it has no Stripe key."""
+    return _get_registry().get(restaurantID)
+
+
+def invalidate(restaurantID):
+    """Forgets the restaurant's client in every worker, e.g. after its key is rotated.
+    The other workers are told once the current transaction commits."""
+    _get_registry().discard(restaurantID)
+    insert_db("SELECT pg_notify('stripe_keys', %s)", args=(str(restaurantID),))